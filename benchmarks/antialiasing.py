@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+ Compares the antialiasing modes of the thumbnail renderer:
+
+   none      - plain poppler rendering at the target resolution
+   bounded   - the current mode, supersampling at up to ANTIALIAS_FACTOR
+               per side within ANTIALIAS_MAX_PIXELS
+   legacy-4x - the former mode, 4x supersampling per side (16x pixels)
+
+ For every mode it reports the time per page, the size of the transient
+ pixbuf and the PSNR against the legacy 4x output, which serves as the
+ quality reference.
+
+ Usage: benchmarks/antialiasing.py file.pdf [gizmo size] [pages]
+"""
+
+import os
+import sys
+import math
+import time
+import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gtk
+import poppler
+import pdfsnip
+
+
+def render(page, gizmo_size, factor):
+    """Render a page the way ThumbnailRenderer does, with a fixed factor"""
+    pix_w, pix_h = page.get_size()
+    width, height, scale = pdfsnip.PixbufUtils.bbox_upscale((pix_w, pix_h), gizmo_size)
+    transient = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8,
+                               width * factor, height * factor)
+    page.render_to_pixbuf(0, 0, width * factor, height * factor,
+                          scale * factor, 0, transient)
+    if factor == 1:
+        return transient, 0
+    thumbnail = transient.scale_simple(width, height, gtk.gdk.INTERP_BILINEAR)
+    return thumbnail, transient.get_rowstride() * transient.get_height()
+
+
+def psnr(pixbuf, reference):
+    """Peak signal-to-noise ratio of two pixbufs of equal size, in dB"""
+    a = array.array('B', pixbuf.get_pixels())
+    b = array.array('B', reference.get_pixels())
+    mse = sum((x - y) * (x - y) for x, y in zip(a, b)) / float(len(a))
+    if mse == 0:
+        return float('inf')
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    filename = os.path.abspath(sys.argv[1])
+    gizmo_size = len(sys.argv) > 2 and int(sys.argv[2]) or 800
+    pages = len(sys.argv) > 3 and int(sys.argv[3]) or 10
+
+    pdfsnip.Preferences.pageWidth = gizmo_size
+    renderer = pdfsnip.ThumbnailRenderer(0)
+    document = poppler.document_new_from_file('file://' + filename, None)
+    pages = min(pages, document.get_n_pages())
+
+    modes = ('none', 'bounded', 'legacy-4x')
+    timings = dict((mode, 0.) for mode in modes)
+    transient = dict((mode, 0) for mode in modes)
+    quality = dict((mode, []) for mode in modes)
+
+    for page_number in range(pages):
+        page = document.get_page(page_number)
+        width, height = pdfsnip.PixbufUtils.bbox_upscale(page.get_size(), gizmo_size)[:2]
+        results = {}
+        for mode in modes:
+            if mode == 'none':
+                factor = 1
+            elif mode == 'bounded':
+                factor = renderer.supersampling_factor(width, height)
+            else:
+                factor = 4
+            start = time.time()
+            results[mode], nbytes = render(page, gizmo_size, factor)
+            timings[mode] += time.time() - start
+            transient[mode] = max(transient[mode], nbytes)
+        for mode in modes:
+            quality[mode].append(psnr(results[mode], results['legacy-4x']))
+
+    print 'File: %s, gizmo size %d, %d pages' % (filename, gizmo_size, pages)
+    print '%-10s %12s %16s %12s' % ('mode', 'ms/page', 'transient MB', 'PSNR dB')
+    for mode in modes:
+        print '%-10s %12.1f %16.1f %12.1f' % (mode,
+                                              1000 * timings[mode] / pages,
+                                              transient[mode] / 1048576.,
+                                              min(quality[mode]))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,18 +29,41 @@
  --------------------------------------------------------------------------
 """
 
+import time
+import __main__
+# Kept when the script runs again as the pdfsnip module, see below
+STARTUP_TIME = getattr(__main__, 'STARTUP_TIME', time.time())
+
 import os
 import shutil       #needed for file operations like whole directory deletion
 import sys          #needed for proccessing of command line args
 import urllib       #needed to parse filename information passed by DnD
 import threading
+import multiprocessing
 import tempfile
 import logging
+import hashlib
+import collections
+import heapq
+import itertools
+import Queue
 
 import locale       #for multilanguage support
 import gettext
 gettext.install('pdfsnip', unicode=1)
 
+if __name__ == '__main__':
+    # The render and export workers are forked before GTK+ is imported,
+    # which opens the display, and before any thread is started. This file
+    # then runs again as the pdfsnip module, which the render workers
+    # import as well to find the jobs they are sent.
+    from pdfsnipcore import RenderPool, ExportPool
+    render_pool = RenderPool()
+    export_pool = ExportPool()
+    import pdfsnip
+    pdfsnip.main(render_pool, export_pool)
+    sys.exit(0)
+
 try:
     import pygtk
     pygtk.require('2.0')
@@ -65,30 +88,52 @@ except:
 import gobject      #to use custom signals
 import pango        #to adjust the text alignment in CellRendererText
 import gconf
-import cairo
 
-try:
-    import djvu.decode
-    found_djvu = True
-except:
-    found_djvu = False
-    print("python-djvulibre wasn't found. Djvu is disabled.")
+# The document model and the export engine, which don't need GTK+
+from pdfsnipcore import have_pypdf, have_pdftk, ListObject, PDF_Doc, DocumentSnapshot, \
+                        DocumentRegistry, file_identity, \
+                        ExportError, ExportCancelled, export_page_list, export_pdf_pages, \
+                        run_pdftk, IncrementalState, read_startxref, \
+                        build_incremental_update, append_to_file, \
+                        IncrementalUpdateError, cpu_count, worker_view_generation
 
-import poppler      #for the rendering of pdf pages
-try:
-    from pyPdf import PdfFileWriter, PdfFileReader
-    found_pypdf = True
-except:
-    found_pypdf = False
-    print("pyPdf wasn't found. Document saving is disabled.")
+# poppler and djvu are imported when the first document is opened
+djvu = None
+found_djvu = None
 
-import subprocess
-try:
-    args = ["pdftk"]
-    subprocess.call(args)
-    found_pdftk = True
-except:
-    found_pdftk = False
+
+def have_djvu():
+    global djvu, found_djvu
+    if found_djvu is None:
+        try:
+            import djvu.decode
+            found_djvu = True
+        except ImportError:
+            found_djvu = False
+            print("python-djvulibre wasn't found. Djvu is disabled.")
+    return found_djvu
+
+
+class StartupTimer:
+    """Times the phases of the startup, logged once the window is drawn"""
+
+    def __init__(self, start):
+        self.start = self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        logging.info("Started in %.0f ms: " % (1000 * (self.last - self.start)) +
+                     ", ".join(["%s %.0f ms" % (phase, 1000 * duration)
+                                for phase, duration in self.phases]))
+
+
+startup_timer = StartupTimer(STARTUP_TIME)
+startup_timer.mark('imports')
 
 
 VERSION = '0.1.1'
@@ -105,17 +150,54 @@ KEY_THUMBNAILS_SIZE = ROOT_DIR + '/thumbnails_size'
 KEY_THUMBNAILS_LAZY = ROOT_DIR + '/thumbnails_lazy'
 KEY_FIT_WIDTH = ROOT_DIR + '/fit_width'
 KEY_FIT_WIDTH_DUAL = ROOT_DIR + '/fit_width_double'
+KEY_RENDER_WORKERS = ROOT_DIR + '/render_workers'
+KEY_THUMBNAILS_CACHE_SIZE = ROOT_DIR + '/thumbnails_cache_size'
+KEY_INCREMENTAL_SAVE = ROOT_DIR + '/incremental_save'
 
 GIZMO_SIZES = [75, 100, 200, 300, 400, 500, 600, 700, 800]
 
+# Imports adding more rows than this to an empty model detach it from the
+# icon view while the rows are added
+ROW_BATCH_DETACH = 64
+
+# Whole PDF documents are probed in the background, one after the other,
+# and added to the model in batches of IMPORT_BATCH_SIZE pages
+IMPORT_BATCH_SIZE = 250
+
+# Progressive rendering: thumbnails at least this large get a quick preview
+# rendered at 1/PREVIEW_FACTOR of the final resolution first
+PREVIEW_MIN_SIZE = 400
+PREVIEW_FACTOR = 4
+
+# Antialiasing supersamples at up to 2x per side, as long as the transient
+# pixbuf stays below this many pixels (see benchmarks/antialiasing.py)
+ANTIALIAS_FACTOR = 2
+ANTIALIAS_MAX_PIXELS = 4 * 1024 * 1024
+
+# Resizing and scrolling: thumbnails are re-rendered at the new width once the
+# size has been stable for RELAYOUT_DELAY ms, the visible range is looked at
+# no more often than every VISIBILITY_UPDATE_INTERVAL ms
+RELAYOUT_DELAY = 300
+VISIBILITY_UPDATE_INTERVAL = 40
+
+# Rendered thumbnails are put into the model in batches of at most
+# THUMBNAIL_FLUSH_MAX, not more often than once per frame
+THUMBNAIL_FLUSH_INTERVAL = 16
+THUMBNAIL_FLUSH_MAX = 128
+
+# Part of the key of every cached thumbnail. Bump it whenever a change to the
+# rendering code changes the pixels, so that the thumbnails cached on disk by
+# an older version are not shown again
+THUMBNAIL_CACHE_VERSION = 1
+
 
 class Preferences:
     """
     Application preferences. Note that not all are being saved to gconf.
     """
     gizmoSize = 2
-    windowWidth = min(700, gtk.gdk.screen_get_default().get_width() / 2)
-    windowHeight = min(600, gtk.gdk.screen_get_default().get_height() - 50)
+    windowWidth = 700           # Limited to the screen size by load()
+    windowHeight = 600
     windowX = 200
     windowY = 200
     preferThumbnails = True
@@ -124,10 +206,19 @@ class Preferences:
     fitPageWidth = False
     fitPageWidthDual = False
     useAntialiazing = False
+    progressiveRendering = True
     pageWidth = 0
+    renderWorkers = cpu_count()  # At most the number of CPUs, see RenderPool
+    thumbnailsCacheSize = 256   # MB on disk, 0 disables the cache
+    thumbnailsMemoryCacheSize = 128 # MB of rendered pixbufs kept in memory
+    incrementalSave = True      # Save appends the changes to the pdf file
 
     @staticmethod
     def load():
+        screen = gtk.gdk.screen_get_default()
+        Preferences.windowWidth = min(Preferences.windowWidth, screen.get_width() / 2)
+        Preferences.windowHeight = min(Preferences.windowHeight, screen.get_height() - 50)
+
         # GConf stuff
         gconf_client = gconf.client_get_default()
         Preferences.gconf_client = gconf_client
@@ -168,6 +259,15 @@ class Preferences:
                 Preferences.fitPageWidthDual = gconf_value
             else:
                 logging.error("Not a BOOL!!!! " + str(gconf_value))
+            gconf_value = gconf_client.get_string(KEY_RENDER_WORKERS)
+            if gconf_value:
+                Preferences.renderWorkers = max(0, int(gconf_value))
+            gconf_value = gconf_client.get_string(KEY_THUMBNAILS_CACHE_SIZE)
+            if gconf_value:
+                Preferences.thumbnailsCacheSize = max(0, int(gconf_value))
+            gconf_value = gconf_client.get(KEY_INCREMENTAL_SAVE)
+            if gconf_value is not None:
+                Preferences.incrementalSave = gconf_value.get_bool()
             logging.debug("Loaded preferences from gconf: " + str(Preferences.__dict__))
         except Exception, e:
             logging.exception(e)
@@ -181,23 +281,13 @@ class Preferences:
         Preferences.gconf_client.set_bool(KEY_THUMBNAILS_LAZY, Preferences.lazyThumbnailsRendering)
         Preferences.gconf_client.set_bool(KEY_FIT_WIDTH, Preferences.fitPageWidth)
         Preferences.gconf_client.set_bool(KEY_FIT_WIDTH_DUAL, Preferences.fitPageWidthDual)
+        Preferences.gconf_client.set_string(KEY_RENDER_WORKERS, str(Preferences.renderWorkers))
+        Preferences.gconf_client.set_string(KEY_THUMBNAILS_CACHE_SIZE, str(Preferences.thumbnailsCacheSize))
+        Preferences.gconf_client.set_bool(KEY_INCREMENTAL_SAVE, Preferences.incrementalSave)
 
         logging.debug("Preferences saved.")
 
 
-class ListObject:
-    def __init__(self):
-        self.text = None            # 0.Text descriptor
-        self.doc_number = None      # 2.Document number
-        self.page_number = None     # 3.Page number
-        self.thumbnail_width = None # 4.Thumbnail width
-        self.thumbnail_size = (0, 0)# Thumbnail size
-        self.doc_filename = None    # 5.Document filename
-        self.rendered = False       # 6.Rendered
-        self.rotation_angle = None  # 7.Rotation angle
-        self.crop = [0., 0., 0., 0.]    # 8.Crop left
-        self.need_to_be_rendered = None # 12.Need to be rendered
-
 class PDFsnip(gtk.Builder):
     MODEL_ROW_INTERN = 1001
     MODEL_ROW_EXTERN = 1002
@@ -209,7 +299,7 @@ class PDFsnip(gtk.Builder):
     TARGETS_SW = [('text/uri-list', 0, TEXT_URI_LIST),
                   ('MODEL_ROW_EXTERN', gtk.TARGET_OTHER_APP, MODEL_ROW_EXTERN)]
 
-    def __init__(self):
+    def __init__(self, render_pool=None, export_pool=None):
         super(PDFsnip, self).__init__()
 
         # Check first in the directory of this script.
@@ -226,8 +316,10 @@ class PDFsnip(gtk.Builder):
 
         self.add_from_file(glade_file)
         self.connect_signals(self)
+        startup_timer.mark('ui file')
 
         Preferences.load()
+        startup_timer.mark('preferences')
 
         self.menuitem12.set_active(Preferences.preferThumbnails)
 
@@ -251,6 +343,8 @@ class PDFsnip(gtk.Builder):
             logging.error("Can't load icon. Application isn't installed correctly.")
 
         self.is_dirty = False
+        # Counts the edits, so that a save can tell if it is still current
+        self.changes = 0
 
         # Create the main window, and attach delete_event signal to terminating
         # the application
@@ -319,6 +413,11 @@ class PDFsnip(gtk.Builder):
         self.iconview.connect('drag_end', self.iv_dnd_leave_end)
         self.iconview.connect('button_press_event', self.iv_button_press_event)
         self.iv_auto_scroll_direction = 0
+        self.visible_range = VisibleRangeTracker()
+        self.column_widths = WidthHistogram()
+        self.reset_iv_width_pending = False
+        for signal in ('row-inserted', 'row-deleted', 'rows-reordered'):
+            self.model.connect(signal, self.visible_range.invalidate)
 
         style = self.iconview.get_style().copy()
         style_sw = sw.get_style()
@@ -327,7 +426,7 @@ class PDFsnip(gtk.Builder):
         self.iconview.set_style(style)
 
         if Preferences.lazyThumbnailsRendering:
-            self.iconview.connect_object('expose-event', self.__on_iconview_visibility_change, self.iconview)
+            self.iconview.connect('expose-event', self.on_iconview_expose)
 
 #        self.iconview.set_margin(0)
 
@@ -355,6 +454,14 @@ class PDFsnip(gtk.Builder):
         self.progress_bar.unrealize()
         self.progress_bar.hide_all()
 
+        self.export_cancel = gtk.Button()
+        self.export_cancel.set_image(gtk.image_new_from_stock(gtk.STOCK_CANCEL, gtk.ICON_SIZE_MENU))
+        self.export_cancel.set_relief(gtk.RELIEF_NONE)
+        self.export_cancel.set_tooltip_text(_('Cancel export'))
+        self.export_cancel.set_no_show_all(True)
+        self.export_cancel.connect('clicked', self.cancel_export)
+        self.statusbar.pack_start(self.export_cancel, False, False, 0)
+
         # Add zoom-in / zoom-out buttons
         btn_zoom_out = gtk.Button(label="-")
         self.statusbar.pack_start(btn_zoom_out, False, False, 0)
@@ -369,7 +476,17 @@ class PDFsnip(gtk.Builder):
         self.nfile = 0
         self.idle = None
         self.iv_auto_scroll_timer = None
+        self.relayout_timer = None
+        self.visibility_timer = None
+        self.delivered = []
+        self.delivered_lock = threading.Lock()
+        self.delivery_timer = None
         self.pdfqueue = []
+        self.documents = DocumentRegistry()
+        self.placeholders = {}
+        self.export_thread = None
+        self.export_pool = export_pool  # Without one, exports fork their own
+        self.imports_pending = 0
 
         gobject.type_register(PDF_Renderer)
         gobject.signal_new('reset_iv_width', PDF_Renderer,
@@ -377,9 +494,26 @@ class PDFsnip(gtk.Builder):
         gobject.signal_new('update_progress_bar', PDF_Renderer,
                            gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, [gobject.TYPE_FLOAT, gobject.TYPE_STRING])
         gobject.signal_new('update_thumbnail', PDF_Renderer,
-                           gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, [gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT])
+                           gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, [gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT])
+        disk_cache = None
+        if Preferences.thumbnailsCacheSize > 0:
+            try:
+                disk_cache = ThumbnailDiskCache(Preferences.thumbnailsCacheSize * 1024 * 1024)
+            except (IOError, OSError), e:
+                logging.error("Thumbnail cache is disabled: " + str(e))
+        memory_cache = None
+        if Preferences.thumbnailsMemoryCacheSize > 0:
+            memory_cache = PixbufMemoryCache(Preferences.thumbnailsMemoryCacheSize * 1024 * 1024)
+        if render_pool is not None and Preferences.renderWorkers == 0:
+            render_pool.pool.terminate()
+            render_pool = None
         self.rendering_thread = PDF_Renderer(self.model, self.pdfqueue,
-                                             0, self.get_current_gizmo_size())
+                                             0, self.get_current_gizmo_size(),
+                                             Preferences.renderWorkers,
+                                             disk_cache, memory_cache,
+                                             PixbufUtils.color_to_rgba(style.base[gtk.STATE_NORMAL]),
+                                             render_pool)
+        startup_timer.mark('widgets')
         self.rendering_thread.connect('reset_iv_width', self.reset_iv_width)
         self.rendering_thread.connect('update_progress_bar', self.update_progress_bar)
         self.rendering_thread.connect('update_thumbnail', self.update_thumbnail)
@@ -387,9 +521,23 @@ class PDFsnip(gtk.Builder):
         self.rendering_thread.daemon = True
         self.rendering_thread.start()
 
+        self.page_probe = PageProbe(self.rendering_thread, self.add_probed_pages)
+        self.page_probe.daemon = True
+        self.page_probe.start()
+
+        startup_timer.mark('renderer')
+
         self.retitle()
 
         self.topWindow.show_all()
+        startup_timer.mark('window')
+
+        # Runs once the window has been drawn
+        gobject.idle_add(self.startup_done)
+
+    def startup_done(self):
+        startup_timer.mark('first frame')
+        startup_timer.report()
 
         self.check_backends()
 
@@ -402,6 +550,7 @@ class PDFsnip(gtk.Builder):
                 self.add_djvu_pages(filename)
             elif self.ext.lower() == '.pdf':
                 self.add_pdf_pages(filename)
+        return False
 
     def __getattr__(self, attr):
         obj = self.get_object(attr)
@@ -424,6 +573,8 @@ class PDFsnip(gtk.Builder):
         pass
 
     def set_dirty(self, flag):
+        if flag:
+            self.changes += 1
         self.is_dirty = flag
         gobject.idle_add(self.retitle)
 
@@ -449,15 +600,48 @@ class PDFsnip(gtk.Builder):
             item.rendered = False
             item.need_to_be_rendered = False
             item.thumbnail_width = 0
-
-        self.rendering_thread.restart_loop = True
-
+        self.column_widths.clear()
+        # Sized for the old zoom, the rows still showing one keep it alive
+        self.placeholders.clear()
+        self.delivered_lock.acquire()
+        del self.delivered[:]
+        self.delivered_lock.release()
+
+        self.rendering_thread.scheduler.clear()
+        self.rendering_thread.invalidate_all()
+        self.visible_range.invalidate()
+
+        if not Preferences.lazyThumbnailsRendering:
+            self.schedule_all_rows()
         self.__on_iconview_visibility_change()
 
-        if self.rendering_thread.paused:
-            self.rendering_thread.paused = False
-            self.rendering_thread.evnt.set()
-            self.rendering_thread.evnt.clear()
+    def schedule_render(self, iter, priority=None):
+        """Queue the row for (re)rendering"""
+        if priority is None:
+            priority = RenderScheduler.VISIBLE
+        obj = self.model.get_value(iter, 2)
+        self.rendering_thread.scheduler.push(obj, iter, priority)
+
+    def schedule_all_rows(self):
+        """Queue every row with background priority"""
+        iter = self.model.get_iter_first()
+        while iter is not None:
+            obj = self.model.get_value(iter, 2)
+            obj.need_to_be_rendered = True
+            self.rendering_thread.scheduler.push(obj, iter, RenderScheduler.BACKGROUND)
+            iter = self.model.iter_next(iter)
+
+    def schedule_unrendered_rows(self):
+        """
+        Queue again the rows still waiting for their thumbnail, e.g. those
+        skipped while their document was being saved
+        """
+        iter = self.model.get_iter_first()
+        while iter is not None:
+            obj = self.model.get_value(iter, 2)
+            if obj.need_to_be_rendered and (not obj.rendered or obj.preview):
+                self.rendering_thread.scheduler.push(obj, iter, RenderScheduler.BACKGROUND)
+            iter = self.model.iter_next(iter)
 
     def toggle_use_thumbnails(self, window, event):
         self.gconf_client.set_bool(KEY_THUMBNAILS, event.get_active())
@@ -474,18 +658,51 @@ class PDFsnip(gtk.Builder):
         if fraction == 1.0:
             self.progress_bar.unrealize()
             self.progress_bar.hide_all()
+        else:
+            self.progress_bar.show()
         gtk.gdk.threads_leave()
 
-    def update_thumbnail(self, object, iter, thumbnail):
+    def update_thumbnail(self, object, iter, job, thumbnail):
+        """Queues a rendered thumbnail, called from the rendering thread"""
+        self.delivered_lock.acquire()
+        try:
+            self.delivered.append((iter, job, thumbnail))
+            if self.delivery_timer is None:
+                self.delivery_timer = gobject.timeout_add(THUMBNAIL_FLUSH_INTERVAL,
+                                                          self.flush_thumbnails)
+        finally:
+            self.delivered_lock.release()
+
+    def flush_thumbnails(self):
+        """Puts the queued thumbnails into the model, one batch per frame"""
+        self.delivered_lock.acquire()
+        try:
+            batch = self.delivered[:THUMBNAIL_FLUSH_MAX]
+            del self.delivered[:THUMBNAIL_FLUSH_MAX]
+            more = len(self.delivered) > 0
+            if not more:
+                self.delivery_timer = None
+        finally:
+            self.delivered_lock.release()
+
+        logging.debug("Updating " + str(len(batch)) + " thumbnails")
         gtk.gdk.threads_enter()
-        logging.debug("Updating thumbnail")
-        if self.model.iter_is_valid(iter):
-            obj = self.model.get_value(iter, 2)
-            obj.rendered = True
-            obj.thumbnail_width = thumbnail.get_width()
-            self.model.set_value(iter, 2, obj)
-            self.model.set_value(iter, 1, thumbnail)
-        gtk.gdk.threads_leave()
+        try:
+            view_generation = self.rendering_thread.view_generation.value
+            for iter, job, thumbnail in batch:
+                if self.model.iter_is_valid(iter):
+                    obj = self.model.get_value(iter, 2)
+                    # The page may have been rotated or zoomed since
+                    if not job.is_current(obj, view_generation):
+                        continue
+                    obj.rendered = True
+                    self.set_thumbnail_width(obj, thumbnail.get_width())
+                    self.model.set_value(iter, 1, thumbnail)
+        finally:
+            gtk.gdk.threads_leave()
+        if batch:
+            self.reset_iv_width()
+        return more
 
     def set_zoom_in(self, window, event=None):
         """Zoom in thunbnails view."""
@@ -540,6 +757,18 @@ class PDFsnip(gtk.Builder):
                 Preferences.pageWidth = int((self.iconview2.get_allocation().width - int(spacings)) / 2)
                 logging.info("Set width to " + str(self.get_current_gizmo_size()))
 
+    def on_iconview_expose(self, view, event):
+        """Coalesces the expose events of scrolling into one update"""
+        if self.visibility_timer is None:
+            self.visibility_timer = gobject.timeout_add(VISIBILITY_UPDATE_INTERVAL,
+                                                        self.on_visibility_timer)
+        return False
+
+    def on_visibility_timer(self):
+        self.visibility_timer = None
+        self.__on_iconview_visibility_change()
+        return False
+
     def __on_iconview_visibility_change(self, view=None, *args):
         logging.debug("__update_visibility")
         vrange = self.iconview.get_visible_range()
@@ -553,27 +782,43 @@ class PDFsnip(gtk.Builder):
             # TODO: Investigate the problem
             self.iconview_col_width = 50
 
+        change = self.visible_range.update(start[0], end[0])
+        if change is None:
+            # Plain repaint, nothing entered or left the viewport
+            return
+        entered, left = change
+
         # Here we drops all images that are out of sight
         if Preferences.fitPageWidth:
-            thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False,
-                                       8, self.iconview_col_width, self.iconview_col_width)
-            for i in range(len(self.model)):
-                if i not in range(start[0], end[0] + 1):
-                    item = self.model[i][2]
-                    item.thumbnail_width = 0
-                    if item.need_to_be_rendered:
-                        item.need_to_be_rendered = False
-                    if not self.model[i][1]:
-                        self.model[i][1] = thumbnail
-
-        for i in range(start[0], end[0] + 1):
-            if not self.model[i][2].need_to_be_rendered:
-                self.model[i][2].need_to_be_rendered = True
-
-        if self.rendering_thread.paused:
-            self.rendering_thread.paused = False
-            self.rendering_thread.evnt.set()
-            self.rendering_thread.evnt.clear()
+            thumbnail = self.get_placeholder(self.iconview_col_width, self.iconview_col_width)
+            for i in left:
+                if i >= len(self.model):
+                    continue
+                item = self.model[i][2]
+                self.set_thumbnail_width(item, 0)
+                if item.need_to_be_rendered:
+                    item.need_to_be_rendered = False
+                if not self.model[i][1]:
+                    self.model[i][1] = thumbnail
+
+        # Visible rows go first, then as many rows ahead in the
+        # direction of scrolling
+        scheduler = self.rendering_thread.scheduler
+        for i in entered:
+            item = self.model[i][2]
+            item.need_to_be_rendered = True
+            if not item.rendered or item.preview:
+                scheduler.push(item, self.model.get_iter(i), RenderScheduler.VISIBLE)
+
+        wanted = set(id(self.model[i][2]) for i in range(start[0], end[0] + 1))
+        for i in self.visible_range.ahead(len(self.model)):
+            item = self.model[i][2]
+            item.need_to_be_rendered = True
+            wanted.add(id(item))
+            if not item.rendered or item.preview:
+                scheduler.push(item, self.model.get_iter(i), RenderScheduler.PREFETCH)
+
+        scheduler.retain(wanted, demote=not Preferences.lazyThumbnailsRendering)
 
     def on_window_size_request(self, window, event):
         """Main Window resize - workaround for autosetting of
@@ -584,25 +829,77 @@ class PDFsnip(gtk.Builder):
 #        print "on_window_size_request", 9 * window.get_size()[0], (10 * (self.iconview_col_width + self.iconview.get_column_spacing() * 2)), 9 * window.get_size()[0] / (10 * (self.iconview_col_width + self.iconview.get_column_spacing() * 2))
 #        print "get_spacing", self.iconview.get_spacing(), "get_row_spacing", self.iconview.get_row_spacing(), "get_column_spacing", self.iconview.get_column_spacing(), "get_margin", self.iconview.get_margin()
 #        self.iconview.set_columns(col_num)
+        if not Preferences.fitPageWidth:
+            return
+        old_width = Preferences.pageWidth
         self.recalculate_gizmo_size()
-        if Preferences.fitPageWidth:
-            self.redraw_thumbnails()
+        if Preferences.pageWidth == old_width:
+            return
+
+        # Stretch what is on screen right away, render for real once the
+        # size settles down
+        if self.relayout_timer is None:
+            self.rendering_thread.scheduler.clear()
+            self.rendering_thread.invalidate_all()
+        else:
+            gobject.source_remove(self.relayout_timer)
+        self.rescale_visible_thumbnails(old_width)
+        self.relayout_timer = gobject.timeout_add(RELAYOUT_DELAY, self.on_relayout_timer)
+
+    def on_relayout_timer(self):
+        self.relayout_timer = None
+        self.redraw_thumbnails()
+        return False
+
+    def rescale_visible_thumbnails(self, old_width):
+        """Quick preview of a new page width made from the current pixbufs"""
+        vrange = self.iconview.get_visible_range()
+        if vrange is None or old_width <= 0:
+            return
+        factor = float(Preferences.pageWidth) / old_width
+        for i in range(vrange[0][0], vrange[1][0] + 1):
+            row = self.model[i]
+            pixbuf = row[1]
+            if pixbuf is None:
+                continue
+            width = max(1, int(pixbuf.get_width() * factor))
+            height = max(1, int(pixbuf.get_height() * factor))
+            self.set_thumbnail_width(row[2], width)
+            row[1] = pixbuf.scale_simple(width, height, gtk.gdk.INTERP_NEAREST)
+        self.set_column_width(Preferences.pageWidth)
+
+    def set_column_width(self, width):
+        self.iconview_col_width = width
+        self.celltxt.set_property('width', width)
+        self.celltxt.set_property('wrap-width', width)
+        self.iconview.set_item_width(width + self.iconview.get_item_padding() * 2)
+
+    def set_thumbnail_width(self, obj, width):
+        """Changes the width of a thumbnail, keeping column_widths in sync"""
+        self.column_widths.remove(obj.thumbnail_width)
+        self.column_widths.add(width)
+        obj.thumbnail_width = width
+
+    def remove_row(self, iter):
+        obj = self.model.get_value(iter, 2)
+        self.rendering_thread.scheduler.discard(obj)
+        self.column_widths.remove(obj.thumbnail_width)
+        self.model.remove(iter)
 
     def reset_iv_width(self, renderer=None):
         """Reconfigures the width of the iconview columns"""
-        gobject.idle_add(self.reset_iv_width_real)
+        if not self.reset_iv_width_pending:
+            self.reset_iv_width_pending = True
+            gobject.idle_add(self.reset_iv_width_real)
 
     def reset_iv_width_real(self):
-        if not len(self.model):
-            return
-        max_w = max(row[2].thumbnail_width for row in self.model)
+        self.reset_iv_width_pending = False
+        max_w = self.column_widths.largest
         logging.debug("(reset_iv_width) Before: " + str(self.iconview_col_width) + " After: " + str(max_w))
-        if max_w != self.iconview_col_width:
-            self.iconview_col_width = max_w
-            self.celltxt.set_property('width', self.iconview_col_width)
-            self.celltxt.set_property('wrap-width', self.iconview_col_width)
-            self.iconview.set_item_width(self.iconview_col_width + self.iconview.get_item_padding() * 2)
+        if max_w and max_w != self.iconview_col_width:
+            self.set_column_width(max_w)
             self.on_window_size_request(self.topWindow, None)
+        return False
 
     def close_application(self, widget, event=None, data=None):
         """Termination"""
@@ -622,9 +919,15 @@ class PDFsnip(gtk.Builder):
         #gtk.gdk.threads_leave()
         self.rendering_thread.quit = True
         #gtk.gdk.threads_enter()
-        if self.rendering_thread.paused:
-             self.rendering_thread.evnt.set()
-             self.rendering_thread.evnt.clear()
+        self.rendering_thread.scheduler.close()
+        self.page_probe.stop()
+        if self.export_thread is not None:
+            self.export_thread.cancel()
+            self.export_thread.join()
+        if self.rendering_thread.pool is not None:
+            self.rendering_thread.pool.terminate()
+        if self.export_pool is not None:
+            self.export_pool.pool.terminate()
         if os.path.isdir(self.tmp_dir):
             shutil.rmtree(self.tmp_dir)
         if gtk.main_level():
@@ -635,21 +938,22 @@ class PDFsnip(gtk.Builder):
 
     def add_djvu_pages(self, filename,
                             firstpage=None, lastpage=None,
-                            angle=0, crop=[0.,0.,0.,0.]):
+                            angle=0, crop=[0.,0.,0.,0.], ordered=True):
         """
         Add pages of a pdf document to the model.
         Note that firstpage and lastpage are zero based.
         """
         logging.debug("add_djvu_pages")
         res = False
+        if not have_djvu():
+            return res
+        if ordered and self.imports_pending and firstpage is None and lastpage is None:
+            # Wait for the documents being imported
+            self.imports_pending += 1
+            self.page_probe.call(self.add_queued_djvu_pages, filename)
+            return True
         # Check if the document has already been loaded
-        pdfdoc = None
-        for it_pdfdoc in self.pdfqueue:
-            if os.path.isfile(it_pdfdoc.filename) and \
-               os.path.samefile(filename, it_pdfdoc.filename) and \
-               os.path.getmtime(filename) is it_pdfdoc.mtime:
-                pdfdoc = it_pdfdoc
-                break
+        pdfdoc = self.documents.lookup(filename)
 
         if not pdfdoc:
             pdfdoc = DJVU_Doc(filename, self.nfile, self.tmp_dir)
@@ -658,6 +962,7 @@ class PDFsnip(gtk.Builder):
             if pdfdoc.nfile != 0 and pdfdoc != []:
                 self.nfile = pdfdoc.nfile
                 self.pdfqueue.append(pdfdoc)
+                self.documents.register(pdfdoc)
             else:
                 return res
 
@@ -668,13 +973,13 @@ class PDFsnip(gtk.Builder):
         if lastpage:
            n_end = max(n_start, min(n_end, lastpage + 1))
 
+        rows = []
         for page_number in range(n_start, n_end):
 #            if only one document:
             descriptor = ''.join([_('page'), ' ', str(page_number + 1)])
             tooltip = ''.join([pdfdoc.shortname, '\n', _('page'), ' ', str(page_number + 1)])
             width = self.iconview_col_width
-            thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False,
-                                       8, width, width)
+            thumbnail = self.get_placeholder(width, width)
             item = ListObject()
             item.text = descriptor
             item.doc_number = pdfdoc.nfile
@@ -683,22 +988,24 @@ class PDFsnip(gtk.Builder):
             item.doc_filename = pdfdoc.filename
             item.rendered = False
             item.rotation_angle = angle
-            item.crop = crop
+            item.crop = list(crop)
             item.need_to_be_rendered = not Preferences.lazyThumbnailsRendering
 
-            self.model.append((descriptor,
-                               thumbnail,
-                               item,
-                               tooltip))
+            rows.append((descriptor,
+                         thumbnail,
+                         item,
+                         tooltip))
             res = True
 
+        self.append_rows(rows)
         gobject.idle_add(self.retitle)
-        if res and self.rendering_thread.paused:
-            self.rendering_thread.paused = False
-            self.rendering_thread.evnt.set()
-            self.rendering_thread.evnt.clear()
         return res
 
+    def add_queued_djvu_pages(self, filename):
+        self.imports_pending -= 1
+        self.add_djvu_pages(filename, ordered=False)
+        return False
+
     def add_pdf_pages(self, filename,
                             firstpage=None, lastpage=None,
                             angle=0, crop=[0.,0.,0.,0.]):
@@ -708,21 +1015,16 @@ class PDFsnip(gtk.Builder):
         """
         res = False
         # Check if the document has already been loaded
-        pdfdoc = None
-        for it_pdfdoc in self.pdfqueue:
-            if os.path.isfile(it_pdfdoc.filename) and \
-               os.path.samefile(filename, it_pdfdoc.filename) and \
-               os.path.getmtime(filename) is it_pdfdoc.mtime:
-                pdfdoc = it_pdfdoc
-                break
+        pdfdoc = self.documents.lookup(filename)
 
         if not pdfdoc:
-            pdfdoc = PDF_Doc(filename, self.nfile, self.tmp_dir)
+            pdfdoc = call_poppler(PDF_Doc, filename, self.nfile, self.tmp_dir)
             self.import_directory = os.path.split(filename)[0]
             self.export_directory = self.import_directory
             if pdfdoc.nfile != 0 and pdfdoc != []:
                 self.nfile = pdfdoc.nfile
                 self.pdfqueue.append(pdfdoc)
+                self.documents.register(pdfdoc)
             else:
                 return res
 
@@ -733,15 +1035,37 @@ class PDFsnip(gtk.Builder):
         if lastpage:
            n_end = max(n_start, min(n_end, lastpage + 1))
 
-        for page_number in range(n_start, n_end):
+        if n_end <= n_start:
+            return res
+
+        if firstpage is None and lastpage is None:
+            # Rows show up in batches while the page sizes are read, after
+            # the documents queued before
+            self.imports_pending += 1
+            self.page_probe.add(pdfdoc, n_start, n_end, angle, crop)
+            return True
+
+        sizes = call_poppler(lambda: [pdfdoc.document.get_page(page_number).get_size()
+                                      for page_number in range(n_start, n_end)])
+        self.add_probed_pages(pdfdoc, n_start, sizes, angle, crop)
+        return True
+
+    def add_probed_pages(self, pdfdoc, first_page, sizes, angle, crop, last=False):
+        """
+        Add pages of a pdf document, starting at first_page, whose sizes
+        have already been read. Also used as an idle callback by the page
+        probe, with last set on the final batch of a document.
+        """
+        if last:
+            self.imports_pending -= 1
+        rows = []
+        for page_number, size in enumerate(sizes, first_page):
 #            if only one document:
             descriptor = ''.join([_('page'), ' ', str(page_number + 1)])
             tooltip = ''.join([pdfdoc.shortname, '\n', _('page'), ' ', str(page_number + 1)])
-            pix_w, pix_h = pdfdoc.document.get_page(page_number).get_size()
-            pix_w, pix_h, pix_scale = PixbufUtils.bbox_upscale((pix_w, pix_h), self.iconview_col_width)
-            
-            thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False,
-                                       8, pix_w, pix_h)
+            pix_w, pix_h, pix_scale = PixbufUtils.bbox_upscale(size, self.iconview_col_width)
+
+            thumbnail = self.get_placeholder(pix_w, pix_h)
             item = ListObject()
             item.text = descriptor
             item.doc_number = pdfdoc.nfile
@@ -751,30 +1075,67 @@ class PDFsnip(gtk.Builder):
             item.doc_filename = pdfdoc.filename
             item.rendered = False
             item.rotation_angle = angle
-            item.crop = crop
+            item.crop = list(crop)
             item.need_to_be_rendered = not Preferences.lazyThumbnailsRendering
 
-            self.model.append((descriptor,
-                               thumbnail,
-                               item,
-                               tooltip))
-            res = True
+            rows.append((descriptor,
+                         thumbnail,
+                         item,
+                         tooltip))
 
+        self.append_rows(rows)
         gobject.idle_add(self.retitle)
-        if res and self.rendering_thread.paused:
-            self.rendering_thread.paused = False
-            self.rendering_thread.evnt.set()
-            self.rendering_thread.evnt.clear()
-        return res
+        return False
+
+    def append_rows(self, rows):
+        """
+        Append (descriptor, thumbnail, item, tooltip) rows to the model.
+        Big batches are added to an empty model with the view detached, so
+        that it lays out once instead of after every row.
+        """
+        # Detaching drops the selection and the scroll position, which only
+        # an empty model can afford
+        detach = len(rows) > ROW_BATCH_DETACH and len(self.model) == 0
+        if detach:
+            self.iconview.set_model(None)
+        try:
+            for row in rows:
+                iter = self.model.append(row)
+                self.column_widths.add(row[2].thumbnail_width)
+                if row[2].need_to_be_rendered:
+                    self.schedule_render(iter, RenderScheduler.BACKGROUND)
+        finally:
+            if detach:
+                self.iconview.set_model(self.model)
+
+    def get_placeholder(self, width, height):
+        """
+        Blank thumbnail shown until a page is rendered. Placeholders are
+        shared by all the pages of the same size and must not be modified.
+        """
+        key = (max(1, width), max(1, height))
+        placeholder = self.placeholders.get(key)
+        if placeholder is None:
+            placeholder = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, key[0], key[1])
+            placeholder.fill(0xffffffff)
+            self.placeholders[key] = placeholder
+        return placeholder
 
     def save_file(self, widget=None, data=None):
+        if self.imports_busy():
+            return
         if len(self.pdfqueue) == 1:
             print "len(self.pdfqueue)", len(self.pdfqueue)
+            changes = self.changes
+            # Edits made while the file was written still have to be saved
+            saved = lambda: changes == self.changes and self.set_dirty(False)
+            filename = self.pdfqueue[0].filename
             if not Preferences.usePdftk:
-                self.export_to_file_using_pypdf(self.pdfqueue[0].filename)
+                save_all = lambda: self.export_to_file_using_pypdf(filename, saved)
             else:
-                self.export_to_file_using_pdftk(self.pdfqueue[0].filename)
-            self.set_dirty(False)
+                save_all = lambda: self.export_to_file_using_pdftk(filename, saved)
+            if not self.save_incremental_update(self.pdfqueue[0], saved, save_all):
+                save_all()
         else:
             error_msg_win = gtk.MessageDialog(flags=gtk.DIALOG_MODAL,
                                               type=gtk.MESSAGE_ERROR,
@@ -785,8 +1146,115 @@ class PDFsnip(gtk.Builder):
             if response == gtk.RESPONSE_OK:
                 error_msg_win.destroy()
 
+    def save_incremental_update(self, pdfdoc, on_success, fallback):
+        """
+        Saves the changes by appending an incremental update to the pdf file,
+        in an ExportThread like the other saves. Returns False when the whole
+        file has to be written instead; fallback() is called to do so when
+        this only turns out while the update is built.
+        """
+        if not Preferences.incrementalSave or not have_pypdf() or \
+           not isinstance(pdfdoc, PDF_Doc):
+            return False
+        if self.export_thread is not None:
+            # Falls through to start_export(), which asks to wait
+            return False
+        try:
+            state = pdfdoc.incremental
+            if state is None:
+                startxref = read_startxref(pdfdoc.copyname)
+                if startxref is None:
+                    return False
+                state = IncrementalState(pdfdoc.identity, startxref)
+            if file_identity(pdfdoc.filename) != state.identity:
+                # Written by someone else, or by a full save
+                return False
+            offset = os.path.getsize(pdfdoc.filename)
+        except (IOError, OSError), e:
+            logging.exception(e)
+            return False
+
+        filename = pdfdoc.filename
+        copyname = pdfdoc.copyname
+        pages = [(row[2].page_number, row[2].rotation_angle, list(row[2].crop))
+                 for row in self.model]
+        rows = [row[2] for row in self.model]
+        updates = []
+
+        def work(progress):
+            try:
+                update = build_incremental_update(copyname, pages, state, offset, progress)
+                if update is not None:
+                    append_to_file(filename, update[0])
+            except ExportCancelled:
+                raise
+            except Exception, e:
+                logging.exception(e)
+                raise IncrementalUpdateError(str(e))
+            if update is None:
+                raise IncrementalUpdateError("The document can't be updated")
+            updates.append(update)
+
+        def appended():
+            data, startxref, first_free, rewritten = updates[0]
+            logging.info("Saved %s as an incremental update of %d bytes" % (filename, len(data)))
+            if pdfdoc.revision() is not None and \
+               file_identity(pdfdoc.copyname) != pdfdoc.revision():
+                # The update went into the file we read the pages from
+                current = [(row[2].page_number, row[2].rotation_angle, list(row[2].crop))
+                           for row in self.model]
+                if current == pages and [row[2] for row in self.model] == rows:
+                    self.rebind_pages(pdfdoc)
+                    pdfdoc.incremental = IncrementalState(pdfdoc.identity, startxref,
+                                                          first_free)
+                    on_success()
+                    return
+                # Edited during the save, the pages still refer to the
+                # previous revision
+                try:
+                    call_poppler(pdfdoc.make_private_copy, offset)
+                    self.schedule_unrendered_rows()
+                except (IOError, OSError), e:
+                    logging.exception(e)
+            state.identity = file_identity(filename)
+            state.startxref = startxref
+            state.first_free = first_free
+            state.rewritten |= rewritten
+            pdfdoc.incremental = state
+            on_success()
+
+        self.start_export(filename, work, appended, fallback)
+        return True
+
+    def rebind_pages(self, pdfdoc):
+        """
+        Reopens pdfdoc once an incremental update has been appended to the
+        file its pages are read from. The rows become the pages of the new
+        revision, which has them in the order of the model, rotated and
+        cropped.
+        """
+        self.documents.unregister(pdfdoc)
+        call_poppler(pdfdoc.reopen)
+        self.documents.register(pdfdoc)
+        iter = self.model.get_iter_first()
+        while iter is not None:
+            obj = self.model.get_value(iter, 2)
+            page_number = self.model.get_path(iter)[0]
+            obj.page_number = page_number
+            obj.rotation_angle = 0
+            obj.crop = [0., 0., 0., 0.]
+            # Renders of the previous revision still running are dropped
+            obj.generation += 1
+            obj.text = ''.join([_('page'), ' ', str(page_number + 1)])
+            self.model.set_value(iter, 0, obj.text)
+            self.model.set_value(iter, 3, ''.join([pdfdoc.shortname, '\n', obj.text]))
+            iter = self.model.iter_next(iter)
+        self.schedule_unrendered_rows()
+
     def choose_export_pdf_name(self, widget=None, data=None):
         """Handles choosing a name for exporting """
+        if self.imports_busy():
+            return
         chooser = gtk.FileChooserDialog(title=_('Export ...'),
                                         action=gtk.FILE_CHOOSER_ACTION_SAVE,
                                         buttons=(gtk.STOCK_CANCEL,
@@ -805,42 +1273,31 @@ class PDFsnip(gtk.Builder):
         filter_all.add_pattern('*')
         chooser.add_filter(filter_all)
 
-        while True:
-            response = chooser.run()
-            if response == gtk.RESPONSE_OK:
-                file_out = chooser.get_filename()
-                (path, shortname) = os.path.split(file_out)
-                (shortname, ext) = os.path.splitext(shortname)
-                if ext.lower() != '.pdf':
-                    file_out += '.pdf'
-                try:
-                    if not Preferences.usePdftk:
-                        self.export_to_file_using_pypdf(file_out)
-                    else:
-                        self.export_to_file_using_pdftk(file_out)
-                    self.export_directory = path
-                except IOError:
-                    error_msg_win = gtk.MessageDialog(flags=gtk.DIALOG_MODAL,
-                                                      type=gtk.MESSAGE_ERROR,
-                       message_format=_("Error writing file: %s") % file_out,
-                                                      buttons=gtk.BUTTONS_OK)
-                    response = error_msg_win.run()
-                    if response == gtk.RESPONSE_OK:
-                        error_msg_win.destroy()
-                    continue
-            break
+        response = chooser.run()
+        if response == gtk.RESPONSE_OK:
+            file_out = chooser.get_filename()
+            (path, shortname) = os.path.split(file_out)
+            (shortname, ext) = os.path.splitext(shortname)
+            if ext.lower() != '.pdf':
+                file_out += '.pdf'
+            # Written in the background, errors are reported by export_done()
+            if not Preferences.usePdftk:
+                self.export_to_file_using_pypdf(file_out)
+            else:
+                self.export_to_file_using_pdftk(file_out)
+            self.export_directory = path
         chooser.destroy()
 
     def check_backends(self):
         """Check backends"""
         msg = None
         go_to_preferences = None
-        if not found_pypdf and not found_pdftk:
+        if not have_pypdf() and not have_pdftk():
             msg = "Neither pypdf or pdftk installed. You won't be able to save your changes."
-        elif not found_pypdf and not Preferences.usePdftk:
+        elif not have_pypdf() and not Preferences.usePdftk:
             msg = "pypdf not installed. Please review your backend settings...\nAfter clicking preferences window will be shown."
             go_to_preferences = True
-        elif not found_pdftk and Preferences.usePdftk:
+        elif not have_pdftk() and Preferences.usePdftk:
             msg = "pdftk not installed. Please review your backend settings...\nAfter clicking preferences window will be shown."
             go_to_preferences = True
         if msg:
@@ -855,66 +1312,109 @@ class PDFsnip(gtk.Builder):
             self.preferences_dialog()
         return msg is None
 
-    def export_to_file_using_pypdf(self, file_out):
+    def protect_sources(self, file_out):
+        """
+        Called before writing file_out. Documents read straight from the
+        output file get a private copy first; hard links keep the original
+        content, as the output replaces the file by a rename. Raises
+        ExportError if a document with pages to write has changed on disk.
+        """
+        used = set(row[2].doc_number for row in self.model)
+        for pdfdoc in self.pdfqueue:
+            if pdfdoc.nfile in used:
+                pdfdoc.check_snapshot()
+            if pdfdoc.snapshot == 'direct' and os.path.exists(file_out) and \
+               os.path.samefile(file_out, pdfdoc.copyname):
+                call_poppler(pdfdoc.make_private_copy)
+
+    def imports_busy(self):
+        """
+        Tells the user to wait while documents are still being imported,
+        as the model only holds some of their pages yet.
+        """
+        if not self.imports_pending:
+            return False
+        error_msg_win = gtk.MessageDialog(flags=gtk.DIALOG_MODAL,
+                                          type=gtk.MESSAGE_ERROR,
+           message_format=_("Please wait until the documents have been loaded."),
+                                          buttons=gtk.BUTTONS_OK)
+        error_msg_win.run()
+        error_msg_win.destroy()
+        return True
+
+    def sources_protected(self, file_out):
+        """protect_sources(), telling the user why file_out can't be written"""
+        try:
+            self.protect_sources(file_out)
+        except ExportError, e:
+            error_msg_win = gtk.MessageDialog(flags=gtk.DIALOG_MODAL,
+                                              type=gtk.MESSAGE_ERROR,
+               message_format=_("Error writing file: %s") % file_out + '\n' + str(e),
+                                              buttons=gtk.BUTTONS_OK)
+            error_msg_win.run()
+            error_msg_win.destroy()
+            return False
+        return True
+
+    def start_export(self, file_out, work, on_success=None, fallback=None):
+        """
+        Runs work(progress) writing file_out in an ExportThread. fallback()
+        is called instead of reporting an IncrementalUpdateError.
+        """
+        if self.export_thread is not None:
+            error_msg_win = gtk.MessageDialog(flags=gtk.DIALOG_MODAL,
+                                              type=gtk.MESSAGE_ERROR,
+               message_format=_("Please wait until %s has been written.") % self.export_thread.file_out,
+                                              buttons=gtk.BUTTONS_OK)
+            error_msg_win.run()
+            error_msg_win.destroy()
+            return
+        self.export_thread = ExportThread(self.rendering_thread, file_out, work,
+                                          on_success, self.export_done, fallback)
+        self.export_cancel.show()
+        self.export_thread.start()
+
+    def export_done(self, thread, error):
+        """Called in the main loop once an ExportThread has finished"""
+        self.export_thread = None
+        self.export_cancel.hide()
+        if error is None:
+            if thread.on_success:
+                thread.on_success()
+        elif isinstance(error, IncrementalUpdateError) and thread.fallback:
+            thread.fallback()
+        elif not isinstance(error, ExportCancelled):
+            error_msg_win = gtk.MessageDialog(flags=gtk.DIALOG_MODAL,
+                                              type=gtk.MESSAGE_ERROR,
+               message_format=_("Error writing file: %s") % thread.file_out + '\n' + str(error),
+                                              buttons=gtk.BUTTONS_OK)
+            error_msg_win.run()
+            error_msg_win.destroy()
+        return False
+
+    def cancel_export(self, button=None):
+        if self.export_thread is not None:
+            self.export_thread.cancel()
+
+    def export_to_file_using_pypdf(self, file_out, on_success=None):
         """Export to file"""
-        if not self.check_backends():
+        if not self.check_backends() or not self.sources_protected(file_out):
             return
 
-        pdf_output = PdfFileWriter()
-        pdf_input = []
-        for pdfdoc in self.pdfqueue:
-            print "&&&& File: ", pdfdoc.copyname
-            pdfdoc_inp = PdfFileReader(file(pdfdoc.copyname, 'rb'))
-            if pdfdoc_inp.getIsEncrypted():
-                if (pdfdoc_inp.decrypt('')!=1): # Workaround for lp:#355479
-                    print(_('File %s is encrypted.') % pdfdoc.filename)
-                    print(_('Support for such files has not been implemented yet.'))
-                    print(_('File export failed.'))
-                    return
-                #FIXME
-                #else
-                #   ask for password and decrypt file
-            pdf_input.append(pdfdoc_inp)
+        pages = export_page_list([row[2] for row in self.model], self.pdfqueue)
 
-        for row in self.model:
-            # add pages from input to output document
-            obj = row[2]
-            current_page = pdf_input[obj.doc_number-1].getPage(obj.page_number)
-            angle = obj.rotation_angle
-            angle0 = current_page.get("/Rotate",0)
-            if angle is not 0:
-                current_page.rotateClockwise(angle)
-            if obj.crop != [0.,0.,0.,0.]:
-                rotate_times = (((angle + angle0) % 360 + 45) / 90) % 4
-                crop_init = obj.crop
-                if rotate_times is not 0:
-                    perm = [0,2,1,3]
-                    for it in range(rotate_times):
-                        perm.append(perm.pop(0))
-                    perm.insert(1,perm.pop(2))
-                    obj.crop = [crop_init[perm[side]] for side in range(4)]
-                #(x1, y1) = current_page.cropBox.lowerLeft
-                #(x2, y2) = current_page.cropBox.upperRight
-                (x1, y1) = [float(xy) for xy in current_page.mediaBox.lowerLeft]
-                (x2, y2) = [float(xy) for xy in current_page.mediaBox.upperRight]
-                x1_new = int(x1 + (x2-x1) * obj.crop[0])
-                x2_new = int(x2 - (x2-x1) * obj.crop[1])
-                y1_new = int(y1 + (y2-y1) * obj.crop[3])
-                y2_new = int(y2 - (y2-y1) * obj.crop[2])
-                #current_page.cropBox.lowerLeft = (x1_new, y1_new)
-                #current_page.cropBox.upperRight = (x2_new, y2_new)
-                current_page.mediaBox.lowerLeft = (x1_new, y1_new)
-                current_page.mediaBox.upperRight = (x2_new, y2_new)
-
-            pdf_output.addPage(current_page)
-
-        # finally, write "output" to document-output.pdf
         print(_('exporting to:'), file_out)
-        pdf_output.write(file(file_out, 'wb'))
-
-    def export_to_file_using_pdftk(self, file_out):
+        workers = cpu_count()
+        tmp_dir = self.tmp_dir
+        export_pool = self.export_pool
+        self.start_export(file_out,
+                          lambda progress: export_pdf_pages(pages, file_out, workers,
+                                                            tmp_dir, progress, export_pool),
+                          on_success)
+
+    def export_to_file_using_pdftk(self, file_out, on_success=None):
         """Export to file using pdftk"""
-        if not self.check_backends():
+        if not self.check_backends() or not self.sources_protected(file_out):
             return
 
         if len(self.pdfqueue) > 1:
@@ -926,13 +1426,13 @@ class PDFsnip(gtk.Builder):
             args = ["pdftk", filename]
             args.append("cat")
             args += pages
-            args.append("output")
-            # finally, write "output" to document-output.pdf
-            args.append(file_out)
 
             print args
 
-            subprocess.call(args)
+            size = os.path.getsize(filename)
+            self.start_export(file_out,
+                              lambda progress: run_pdftk(args, file_out, size, progress),
+                              on_success)
 
     def on_action_add_doc_activate(self, widget, data=None):
         """Import doc"""
@@ -986,7 +1486,7 @@ class PDFsnip(gtk.Builder):
             self.set_dirty(True)
             iters = [model.get_iter(path) for path in selection]
             for iter in iters:
-                model.remove(iter)
+                self.remove_row(iter)
 
             iter_next_selected = model.get_path(iters[-1])
 
@@ -999,23 +1499,9 @@ class PDFsnip(gtk.Builder):
                     self.iconview.select_path(path)
             self.iconview.grab_focus()
 
-            if self.rendering_thread.paused:
-                self.rendering_thread.paused = False
-                self.rendering_thread.evnt.set()
-                self.rendering_thread.evnt.clear()
-            
     def load_all_thumbnails(self, button=None, data=None):
         """Load all thumbs"""
-        for row in self.model:
-            item = row[2]
-            item.need_to_be_rendered = True
-
-        self.rendering_thread.restart_loop = True
-
-        if self.rendering_thread.paused:
-            self.rendering_thread.paused = False
-            self.rendering_thread.evnt.set()
-            self.rendering_thread.evnt.clear()
+        self.schedule_all_rows()
 
     def iv_drag_begin(self, iconview, context):
         """Sets custom icon on drag begin for multiple items selected"""
@@ -1084,10 +1570,12 @@ class PDFsnip(gtk.Builder):
                             model.insert_before(iter_to, row)
                         else:
                             model.insert_after(iter_to, row)
+                        self.column_widths.add(row[2].thumbnail_width)
                     if context.action == gtk.gdk.ACTION_MOVE:
                         for ref_from in ref_from_list:
                             path = ref_from.get_path()
                             iter_from = model.get_iter(path)
+                            self.column_widths.remove(model.get_value(iter_from, 2).thumbnail_width)
                             model.remove(iter_from)
 
                 #elif target_id == self.MODEL_ROW_EXTERN:
@@ -1122,7 +1610,7 @@ class PDFsnip(gtk.Builder):
         for ref_del in ref_del_list:
             path = ref_del.get_path()
             iter = model.get_iter(path)
-            model.remove(iter)
+            self.remove_row(iter)
 
     def iv_dnd_motion(self, iconview, context, x, y, etime):
         """Handles the drag-motion signal in order to auto-scroll the view"""
@@ -1249,11 +1737,8 @@ class PDFsnip(gtk.Builder):
 
             obj.rotation_angle = obj.rotation_angle + angle
             obj.rendered = False
-
-        if self.rendering_thread.paused:
-            self.rendering_thread.paused = False
-            self.rendering_thread.evnt.set()
-            self.rendering_thread.evnt.clear()
+            obj.generation += 1
+            self.schedule_render(iter)
 
 
     def file_info(self, widget, event=None):
@@ -1342,10 +1827,8 @@ class PDFsnip(gtk.Builder):
                 listObject = model.get_value(iter, 2)
                 listObject.crop = crop
                 listObject.rendered = False
-            if self.rendering_thread.paused:
-                self.rendering_thread.paused = False
-                self.rendering_thread.evnt.set()
-                self.rendering_thread.evnt.clear()
+                listObject.generation += 1
+                self.schedule_render(iter)
         elif result == gtk.RESPONSE_CANCEL:
             print(_('Dialog closed'))
         dialog.hide()
@@ -1383,107 +1866,495 @@ class PDFsnip(gtk.Builder):
     def icon_view_resized(self):
         print "."
 
-class PDF_Doc:
-    """Class handling pdf documents"""
+class DJVU_Doc(DocumentSnapshot):
+    """Class handling djvu documents"""
 
     def __init__(self, filename, nfile, tmp_dir):
 
+        print "DJVU_Doc.__init__"
+        self.djvu_context = djvu.decode.Context()
+
         self.filename = os.path.abspath(filename)
         (self.path, self.shortname) = os.path.split(self.filename)
         (self.shortname, self.ext) = os.path.splitext(self.shortname)
-        if self.ext.lower() == '.pdf':
+        if self.ext.lower() == '.djvu':
             self.nfile = nfile + 1
-            self.mtime = os.path.getmtime(filename)
-            self.copyname = os.path.join(tmp_dir, '%02d_' % self.nfile +
-                                                  self.shortname + '.pdf')
-            shutil.copy(self.filename, self.copyname)
-            self.document = poppler.document_new_from_file ("file://" + self.copyname, None)
-            self.number_of_pages = self.document.get_n_pages()
+            self.identity = file_identity(self.filename)
+            self.mtime = self.identity[3]
+            self.take_snapshot(tmp_dir)
+            self.open_document()
+            self.number_of_pages = len(self.document.pages)
         else:
             self.nfile = 0
 
+    def open_document(self):
+        self.document = self.djvu_context.new_document(djvu.decode.FileURI(self.copyname))
+#        self.document = poppler.document_new_from_file ("file://" + self.copyname, None)
+        self.document.decoding_job.wait()
 
-class DJVU_Doc:
-    """Class handling djvu documents"""
 
-    def __init__(self, filename, nfile, tmp_dir):
+# poppler isn't thread safe. Without a render pool, the main loop, the
+# PageProbe and the render thread all use it, one at a time.
+poppler_lock = threading.Lock()
 
-        print "DJVU_Doc.__init__"
-        self.djvu_context = djvu.decode.Context()
 
-        self.filename = os.path.abspath(filename)
-        (self.path, self.shortname) = os.path.split(self.filename)
-        (self.shortname, self.ext) = os.path.splitext(self.shortname)
-        if self.ext.lower() == '.djvu':
-            self.nfile = nfile + 1
-            self.mtime = os.path.getmtime(filename)
-            self.copyname = os.path.join(tmp_dir, '%02d_' % self.nfile +
-                                                  self.shortname + '.pdf')
-            shutil.copy(self.filename, self.copyname)
-            self.document = self.djvu_context.new_document(djvu.decode.FileURI(self.copyname))
-#            self.document = poppler.document_new_from_file ("file://" + self.copyname, None)
+def call_poppler(func, *args):
+    """Calls func(*args) holding poppler_lock"""
+    poppler_lock.acquire()
+    try:
+        return func(*args)
+    finally:
+        poppler_lock.release()
+
+
+def probe_page_sizes(copyname, revision, start, end):
+    """
+    Sizes of the pages start..end-1 of a pdf copy. Runs in a render worker
+    process, or in the PageProbe thread when there is no pool.
+    """
+    document = worker_document('pdf', copyname, revision).document
+    return [document.get_page(page_number).get_size()
+            for page_number in range(start, end)]
+
+
+class PageProbe(threading.Thread):
+    """
+    Reads the page sizes of big documents away from the main loop and
+    hands them over in batches, so that the first pages can be used while
+    the rest of the document is still being imported. The reading is done
+    by the render worker pool when there is one.
+    """
+
+    def __init__(self, renderer, callback):
+        threading.Thread.__init__(self)
+        self.renderer = renderer
+        self.callback = callback
+        self.queue = Queue.Queue()
+
+    def add(self, pdfdoc, start, end, angle, crop):
+        self.queue.put((pdfdoc, start, end, angle, list(crop)))
+
+    def call(self, func, *args):
+        """
+        Calls func(*args) in the main loop once the documents queued before
+        have been handed over, so that imports keep their order.
+        """
+        self.queue.put((func, args))
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            if len(task) == 2:
+                func, args = task
+                gobject.idle_add(func, *args)
+                continue
+            pdfdoc, start, end, angle, crop = task
+            try:
+                for batch_start in range(start, end, IMPORT_BATCH_SIZE):
+                    batch_end = min(end, batch_start + IMPORT_BATCH_SIZE)
+                    args = (pdfdoc.copyname, pdfdoc.revision(), batch_start, batch_end)
+                    if self.renderer.pool is not None:
+                        sizes = self.renderer.pool.apply(probe_page_sizes, args)
+                    else:
+                        sizes = call_poppler(probe_page_sizes, *args)
+                    gobject.idle_add(self.callback, pdfdoc, batch_start, sizes,
+                                     angle, crop, batch_end == end)
+                    self.renderer.emit('update_progress_bar',
+                                       float(batch_end - start) / (end - start),
+                                       "Loading %s... [%d/%d]" % (pdfdoc.shortname,
+                                                                  batch_end - start,
+                                                                  end - start))
+            except Exception, e:
+                logging.exception(e)
+                gobject.idle_add(self.callback, pdfdoc, end, [], angle, crop, True)
+                self.renderer.emit('update_progress_bar', 1.0, "")
+        logging.info("The page probing thread has been stopped.")
+
+
+class ExportThread(threading.Thread):
+    """
+    Writes an export away from the main loop. work() is called with a
+    progress function taking the fraction done, which also stops the export
+    once cancel() has been called. callback(thread, error) is called in the
+    main loop at the end, with error None on success. fallback is kept for
+    the callback, which calls it when work() can't do its job.
+    """
+
+    def __init__(self, renderer, file_out, work, on_success, callback, fallback=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.renderer = renderer
+        self.file_out = file_out
+        self.work = work
+        self.on_success = on_success
+        self.fallback = fallback
+        self.callback = callback
+        self.cancelled = False
+        self.percent = None
+        self.title = os.path.basename(file_out)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, fraction):
+        if self.cancelled:
+            raise ExportCancelled()
+        percent = int(fraction * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.renderer.emit('update_progress_bar', min(fraction, 0.99),
+                               "Writing %s... [%d%%]" % (self.title, percent))
+
+    def run(self):
+        error = None
+        try:
+            self.progress(0.)
+            self.work(self.progress)
+        except Exception, e:
+            if not isinstance(e, ExportCancelled):
+                logging.exception(e)
+            error = e
+        self.renderer.emit('update_progress_bar', 1.0, "")
+        gobject.idle_add(self.callback, self, error)
+
+
+class RenderJob:
+    """
+    Self-contained description of a single thumbnail to render. Jobs are
+    pickled and sent to the render worker processes, so they carry a
+    snapshot of every setting the rendering code reads from Preferences.
+    """
+    def __init__(self, pdfdoc, obj, renderer, view_generation=0):
+        self.kind = 'djvu' if isinstance(pdfdoc, DJVU_Doc) else 'pdf'
+        self.copyname = pdfdoc.copyname
+        self.revision = pdfdoc.revision()
+        self.identity = pdfdoc.identity
+        self.page_number = obj.page_number
+        self.rotation_angle = obj.rotation_angle
+        self.crop = list(obj.crop)
+        self.prefer_thumbnails = renderer.prefer_thumbnails
+        self.scale = renderer.scale
+        self.background = renderer.background
+        self.preferences = {'gizmoSize': Preferences.gizmoSize,
+                            'fitPageWidth': Preferences.fitPageWidth,
+                            'pageWidth': Preferences.pageWidth,
+                            'useAntialiazing': Preferences.useAntialiazing}
+        self.cache_file = None
+        self.generation = (view_generation, obj.generation)
+        self.preview = False
+
+    def is_current(self, obj, view_generation):
+        """False once the page or the whole view has changed since"""
+        return self.generation == (view_generation, obj.generation)
+
+    def cache_key(self):
+        """Digest of everything the finished thumbnail depends on"""
+        key = (THUMBNAIL_CACHE_VERSION,
+               self.identity, self.page_number, self.rotation_angle % 360,
+               tuple(self.crop), GIZMO_SIZES[self.preferences['gizmoSize']],
+               self.preferences['fitPageWidth'], self.preferences['pageWidth'],
+               self.preferences['useAntialiazing'], self.prefer_thumbnails)
+        return hashlib.sha1(repr(key)).hexdigest()
+
+
+class DocumentHandle:
+    """
+    Per-process handle on the temporary copy of an imported document.
+    Raises ExportError when the copy no longer is at the revision given,
+    e.g. while an incremental update is being appended to it.
+    """
+
+    def __init__(self, kind, copyname, revision=None):
+        if kind == 'djvu':
+            have_djvu()
+            self.djvu_context = djvu.decode.Context()
+            self.document = self.djvu_context.new_document(djvu.decode.FileURI(copyname))
             self.document.decoding_job.wait()
-            self.number_of_pages = len(self.document.pages)
         else:
-            self.nfile = 0
+            import poppler
+            self.document = poppler.document_new_from_file("file://" + copyname, None)
+        # Checked once opened, what was read is older than what is found
+        if revision is not None and file_identity(copyname) != revision:
+            raise ExportError(_('File %s has changed since it was opened.') % copyname)
+
+
+# State private to each render worker process
+_worker_renderer = None
+_worker_documents = {}
+
+
+def worker_document(kind, copyname, revision):
+    """The DocumentHandle of this process on a revision of copyname"""
+    key = (kind, copyname, revision)
+    handle = _worker_documents.get(key)
+    if handle is None:
+        for old_key in _worker_documents.keys():
+            if old_key[:2] == key[:2]:
+                # An earlier revision, replaced by an incremental update
+                del _worker_documents[old_key]
+        handle = DocumentHandle(kind, copyname, revision)
+        _worker_documents[key] = handle
+    return handle
+
+
+def worker_renderer(scale, background):
+    """The ThumbnailRenderer of this process for scale and background"""
+    global _worker_renderer
+    if _worker_renderer is None or \
+       (_worker_renderer.scale, _worker_renderer.background) != (scale, background):
+        _worker_renderer = ThumbnailRenderer(scale, background)
+    return _worker_renderer
+
+
+def render_worker_job(job):
+    """
+    Entry point of the render worker processes. Returns the finished
+    thumbnail as raw pixel data (see PixbufUtils.to_data) together with
+    the number of bytes written to the disk cache, or None. Jobs queued
+    before the last zoom change are skipped without rendering.
+    """
+    if job.generation[0] != worker_view_generation().value:
+        return None
+    try:
+        for name, value in job.preferences.items():
+            setattr(Preferences, name, value)
+        handle = worker_document(job.kind, job.copyname, job.revision)
+        renderer = worker_renderer(job.scale, job.background)
+        renderer.set_prefer_thumbnails(job.prefer_thumbnails)
+        if job.kind == 'djvu':
+            thumbnail = renderer.load_djvu_thumbnail(handle, job.page_number,
+                                                     job.rotation_angle, job.crop)
+        else:
+            thumbnail = renderer.load_pdf_thumbnail(handle, job.page_number,
+                                                    job.rotation_angle, job.crop,
+                                                    job.preview)
+        stored = 0
+        if job.cache_file and not job.preview:
+            stored = ThumbnailDiskCache.store(job.cache_file, thumbnail)
+        return PixbufUtils.to_data(thumbnail), stored
+    except Exception, e:
+        logging.exception(e)
+        return None
+
+
+class RenderScheduler:
+    """
+    Priority queue of the pages waiting for a thumbnail. Pages in the
+    viewport go first, then full quality renders replacing their previews,
+    then the prefetched pages ahead of the viewport, then the rest.
+    Queueing a page again only raises its priority.
+    """
+    VISIBLE = 0
+    REFINE = 1
+    PREFETCH = 2
+    BACKGROUND = 3
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}   # id(ListObject) -> [priority, seq, obj, iter, valid]
+        self.foreground = set() # ids queued above the background priority
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def push(self, obj, iter, priority):
+        self.cond.acquire()
+        try:
+            entry = self.entries.get(id(obj))
+            if entry is not None:
+                entry[3] = iter
+                if entry[0] <= priority:
+                    return
+                entry[4] = False
+            entry = [priority, self.counter.next(), obj, iter, True]
+            self.entries[id(obj)] = entry
+            if priority < self.BACKGROUND:
+                self.foreground.add(id(obj))
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def discard(self, obj):
+        """Forget a page, e.g. because its row was deleted"""
+        self.cond.acquire()
+        try:
+            entry = self.entries.pop(id(obj), None)
+            if entry is not None:
+                entry[4] = False
+            self.foreground.discard(id(obj))
+        finally:
+            self.cond.release()
+
+    def retain(self, wanted, demote=False):
+        """
+        Drop visible and prefetch entries whose ids are not in wanted, or
+        move them to the background priority if demote is set.
+        """
+        self.cond.acquire()
+        try:
+            for key in self.foreground - wanted:
+                self.foreground.discard(key)
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    entry[4] = False
+                    if demote:
+                        entry = [self.BACKGROUND, self.counter.next(), entry[2], entry[3], True]
+                        self.entries[key] = entry
+                        heapq.heappush(self.heap, entry)
+        finally:
+            self.cond.release()
+
+    def clear(self):
+        self.cond.acquire()
+        try:
+            self.heap = []
+            self.entries = {}
+            self.foreground = set()
+        finally:
+            self.cond.release()
+
+    def pop(self):
+        """
+        Block until a page is queued and return it as (obj, iter, priority),
+        or None once the scheduler has been closed.
+        """
+        self.cond.acquire()
+        try:
+            while not self.closed:
+                while self.heap:
+                    entry = heapq.heappop(self.heap)
+                    if entry[4]:
+                        del self.entries[id(entry[2])]
+                        self.foreground.discard(id(entry[2]))
+                        return entry[2], entry[3], entry[0]
+                self.cond.wait()
+            return None
+        finally:
+            self.cond.release()
+
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notify_all()
+        self.cond.release()
 
 
 class PDF_Renderer(threading.Thread, gobject.GObject):
+    """
+    Takes pages from the RenderScheduler and hands them over to the worker
+    processes of render_pool, using up to workers of them. With zero
+    workers or no pool the pages are rendered in this thread instead.
+    """
 
-    def __init__(self, model, pdfqueue, scale=1., width=100):
+    def __init__(self, model, pdfqueue, scale=1., width=100, workers=0,
+                 disk_cache=None, memory_cache=None, background=0xFFFFFFFF,
+                 render_pool=None):
         threading.Thread.__init__(self)
         gobject.GObject.__init__(self)
         self.model = model
-        self.scale = scale
         self.pdfqueue = pdfqueue
         self.quit = False
-        self.evnt = threading.Event()
-        self.paused = False
-        self.antialiazing_factor = 4
-        self.prefer_thumbnails = True
-        self.restart_loop = False
+        self.scheduler = RenderScheduler()
+        self.renderer = ThumbnailRenderer(scale, background)
+        self.disk_cache = disk_cache
+        self.memory_cache = memory_cache
+        self.pool = None
+        if render_pool is not None and workers > 0:
+            # Shared with the workers so that they can skip outdated jobs
+            self.view_generation = render_pool.view_generation
+            self.pool = render_pool.pool
+            workers = min(workers, render_pool.workers)
+        else:
+            self.view_generation = multiprocessing.Value('i', 0)
+        # (id(ListObject), generation) of the jobs not finished yet. When
+        # the whole pool is used a job waits behind each running one, else
+        # no more are sent than processes may render at once
+        self.max_in_flight = max(1, workers)
+        if self.pool is not None and workers == render_pool.workers:
+            self.max_in_flight = 2 * workers
+        self.in_flight = set()
+        self.in_flight_cond = threading.Condition()
+        # Serialises deliver() between this thread and the pool's results
+        self.deliver_lock = threading.Lock()
 
     def set_prefer_thumbnails(self, flag):
-        self.prefer_thumbnails = flag
+        self.renderer.set_prefer_thumbnails(flag)
+
+    def invalidate_all(self):
+        """Mark every queued or running job as stale"""
+        self.view_generation.value += 1
 
     def run(self):
         while not self.quit:
-            iter = self.model.get_iter_first()
-            while iter is not None and self.model.iter_is_valid(iter):
-                if self.quit:
-                    break
-                if self.restart_loop:
-                    self.restart_loop = False
-                    # Rewind to the first item
-                    iter = self.model.get_iter_first()
-                obj = self.model.get_value(iter, 2)
-                is_thumbnails_changed = self.process_item(iter, obj)
-                if is_thumbnails_changed:
-                    self.emit('reset_iv_width')
-                iter = self.model.iter_next(iter)
-
-            self.paused = True
-#            if self.model.get_iter_first(): #just checking if model isn't empty
-#                self.emit('reset_iv_width') # TODO: Remove that
-#                gobject.idle_add(self.reset_iv_width)
-            self.evnt.wait()
+            task = self.scheduler.pop()
+            if task is None:
+                break
+            obj, iter, priority = task
+            if not self.model.iter_is_valid(iter):
+                continue
+            is_thumbnails_changed = self.process_item(iter, obj, priority)
+            if is_thumbnails_changed:
+                self.emit('reset_iv_width')
 
         logging.info("The rendering thread has been stopped.")
 
-    def process_item(self, iter, obj):
+    def wants_preview(self):
+        return Preferences.progressiveRendering and \
+               (Preferences.fitPageWidth or
+                GIZMO_SIZES[Preferences.gizmoSize] >= PREVIEW_MIN_SIZE)
+
+    def process_item(self, iter, obj, priority=RenderScheduler.BACKGROUND):
         """
         @type obj: ListObject
         """
-        if not obj.rendered and obj.need_to_be_rendered:
+        if (not obj.rendered or obj.preview) and obj.need_to_be_rendered:
+            pdfdoc = self.pdfqueue[obj.doc_number - 1]
+            view_generation = self.view_generation.value
+            job = RenderJob(pdfdoc, obj, self.renderer, view_generation)
+            if obj.delivered == job.generation:
+                # Handed over already, the model shows it on the next flush
+                return False
+            key = job.cache_key()
+            if self.memory_cache is not None:
+                thumbnail = self.memory_cache.get(key)
+                if thumbnail is not None:
+                    self.deliver(iter, obj, job, key, thumbnail)
+                    return True
+            if self.disk_cache is not None:
+                job.cache_file = self.disk_cache.path_for(key)
+                thumbnail = self.disk_cache.load(job.cache_file)
+                if thumbnail is not None:
+                    self.deliver(iter, obj, job, key, thumbnail)
+                    return True
+            if pdfdoc.snapshot_changed():
+                # The file no longer has these pages, keep the placeholder
+                return False
+            if priority == RenderScheduler.VISIBLE and not obj.rendered and \
+               job.kind == 'pdf' and self.wants_preview():
+                # First pass; the full quality render follows once every
+                # visible page has its preview
+                job.preview = True
+                self.scheduler.push(obj, iter, RenderScheduler.REFINE)
+            if self.pool is not None:
+                # The thumbnail is delivered later by job_done()
+                self.submit_job(iter, obj, job, key)
+                return False
 #                    gtk.gdk.threads_enter() # Overusing of threads_enter for models
             try:
-                pdfdoc = self.pdfqueue[obj.doc_number - 1]
                 if isinstance(pdfdoc, PDF_Doc):
-                    thumbnail = self.load_pdf_thumbnail(pdfdoc, obj.page_number, obj.rotation_angle, obj.crop)
+                    thumbnail = call_poppler(self.renderer.load_pdf_thumbnail, pdfdoc, obj.page_number, obj.rotation_angle, obj.crop, job.preview)
                 elif isinstance(pdfdoc, DJVU_Doc):
-                    thumbnail = self.load_djvu_thumbnail(pdfdoc, obj.page_number, obj.rotation_angle, obj.crop)
+                    thumbnail = self.renderer.load_djvu_thumbnail(pdfdoc, obj.page_number, obj.rotation_angle, obj.crop)
 
-                self.emit('update_thumbnail', iter, thumbnail)
+                self.deliver(iter, obj, job, key, thumbnail)
+                if job.cache_file and not job.preview:
+                    self.disk_cache.account(ThumbnailDiskCache.store(job.cache_file, thumbnail))
             except Exception, e:
                 print e
             finally:
@@ -1497,6 +2368,230 @@ class PDF_Renderer(threading.Thread, gobject.GObject):
         else:
             return False
 
+    def submit_job(self, iter, obj, job, key):
+        """Queue the page for rendering in the worker pool"""
+        token = (id(obj), job.generation, job.preview)
+        self.in_flight_cond.acquire()
+        try:
+            if token in self.in_flight:
+                return
+            while len(self.in_flight) >= self.max_in_flight and not self.quit:
+                self.in_flight_cond.wait()
+            # The page may have been rotated or zoomed while we waited
+            if not job.is_current(obj, self.view_generation.value):
+                return
+            self.in_flight.add(token)
+        finally:
+            self.in_flight_cond.release()
+
+        callback = lambda result: self.job_done(iter, obj, job, key, result)
+        self.pool.apply_async(render_worker_job, (job,), callback=callback)
+
+    def job_done(self, iter, obj, job, key, result):
+        """Called from the pool result thread when a worker has finished"""
+        try:
+            if result is not None and not self.quit:
+                data, stored = result
+                if self.deliver(iter, obj, job, key, PixbufUtils.from_data(data)):
+                    self.emit('reset_iv_width')
+                if stored and self.disk_cache is not None:
+                    self.disk_cache.account(stored)
+        except Exception, e:
+            logging.exception(e)
+        finally:
+            self.in_flight_cond.acquire()
+            self.in_flight.discard((id(obj), job.generation, job.preview))
+            self.in_flight_cond.notify_all()
+            self.in_flight_cond.release()
+
+    def deliver(self, iter, obj, job, key, thumbnail):
+        """
+        Hand a finished thumbnail over unless it has gone stale. The page
+        records the generation it got a full quality thumbnail for as soon
+        as it is handed over, as the model only shows it a frame later.
+        """
+        if not job.preview:
+            # Still valid for its own key, even if the page has moved on
+            self.remember(key, thumbnail)
+        self.deliver_lock.acquire()
+        try:
+            if not job.is_current(obj, self.view_generation.value):
+                return False
+            if job.preview and obj.delivered == job.generation:
+                # The full quality render won the race
+                return False
+            obj.preview = job.preview
+            if not job.preview:
+                obj.delivered = job.generation
+            self.emit('update_thumbnail', iter, job, thumbnail)
+        finally:
+            self.deliver_lock.release()
+        return True
+
+    def remember(self, key, thumbnail):
+        if self.memory_cache is not None:
+            self.memory_cache.put(key, thumbnail)
+
+
+class PixbufMemoryCache:
+    """
+    Rendered thumbnails of every zoom level, keyed by RenderJob.cache_key().
+    The least recently used pixbufs are dropped, whatever their size, once
+    the pixel data goes over the byte budget.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            thumbnail = self.items.pop(key, None)
+            if thumbnail is not None:
+                self.items[key] = thumbnail
+            return thumbnail
+        finally:
+            self.lock.release()
+
+    def put(self, key, thumbnail):
+        nbytes = thumbnail.get_rowstride() * thumbnail.get_height()
+        if nbytes > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.get_rowstride() * old.get_height()
+            self.items[key] = thumbnail
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                key, old = self.items.popitem(last=False)
+                self.total_bytes -= old.get_rowstride() * old.get_height()
+        finally:
+            self.lock.release()
+
+
+class ThumbnailDiskCache:
+    """
+    Finished thumbnails stored as PNG files under the XDG cache directory.
+    Files are named after RenderJob.cache_key(); their mtime is bumped on
+    every hit so that eviction can drop the least recently used ones once
+    the total size goes over the limit.
+    """
+
+    def __init__(self, max_bytes, directory=None):
+        if directory is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or \
+                         os.path.join(os.path.expanduser('~'), '.cache')
+            directory = os.path.join(cache_home, 'pdfsnip', 'thumbnails')
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = None     # computed on first use
+        self.lock = threading.Lock()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def load(self, path):
+        """Return the cached pixbuf or None"""
+        if not os.path.isfile(path):
+            return None
+        try:
+            thumbnail = gtk.gdk.pixbuf_new_from_file(path)
+            os.utime(path, None)
+            return thumbnail
+        except Exception, e:
+            logging.debug("Dropping unreadable cache entry %s: %s" % (path, e))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    @staticmethod
+    def store(path, thumbnail):
+        """
+        Save a thumbnail; safe to call from the render worker processes.
+        Returns the number of bytes written.
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            thumbnail.save(tmp_path, 'png')
+            os.rename(tmp_path, path)
+            return os.path.getsize(path)
+        except Exception, e:
+            logging.debug("Can't store thumbnail %s: %s" % (path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return 0
+
+    def account(self, nbytes):
+        """Record newly stored bytes and evict old entries if needed"""
+        self.lock.acquire()
+        try:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for size, mtime, path in self.entries())
+            else:
+                self.total_bytes += nbytes
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+        finally:
+            self.lock.release()
+
+    def entries(self):
+        result = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            result.append((st.st_size, st.st_mtime, path))
+        return result
+
+    def evict(self):
+        """Remove least recently used files down to 90% of the limit"""
+        target = self.max_bytes * 9 / 10
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        self.total_bytes = sum(entry[0] for entry in entries)
+        for size, mtime, path in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+        logging.debug("Thumbnail cache evicted down to %d bytes" % self.total_bytes)
+
+
+class ThumbnailRenderer:
+    """
+    Turns document pages into decorated thumbnail pixbufs. Used both by
+    the rendering thread and by the render worker processes.
+    """
+
+    def __init__(self, scale=1., background=0xFFFFFFFF):
+        self.scale = scale
+        self.antialiazing_factor = ANTIALIAS_FACTOR
+        self.prefer_thumbnails = True
+        self.background = background    # RGBA, shows in two corner pixels
+
+    def set_prefer_thumbnails(self, flag):
+        self.prefer_thumbnails = flag
+
+    def supersampling_factor(self, pix_w, pix_h):
+        """Supersampling factor for an antialiased thumbnail of pix_w x pix_h"""
+        factor = self.antialiazing_factor
+        while factor > 1 and pix_w * pix_h * factor * factor > ANTIALIAS_MAX_PIXELS:
+            factor -= 1
+        return factor
+
     def scale_pixbuf(self, pixbuf, gizmo_size):
         pix_w = pixbuf.get_width()
         pix_h = pixbuf.get_height()
@@ -1510,115 +2605,91 @@ class PDF_Renderer(threading.Thread, gobject.GObject):
                         gtk.gdk.INTERP_BILINEAR)
         return thumbnail_small
 
-    def render_pdf_page(self, page, gizmo_size, prefer_thumbs=True):
-        """Create pixbuf from page"""
-        got_pixbuf = False
-        if prefer_thumbs:
+    def render_pdf_page(self, page, gizmo_size, prefer_thumbs=True, preview=False,
+                        rotation=0, crop=[0.,0.,0.,0.]):
+        """
+        Create the decorated thumbnail of a page. Rotation and crop are done
+        by poppler, so only the visible part of the page gets rasterised.
+        """
+        if prefer_thumbs or preview:
             thumbnail = page.get_thumbnail_pixbuf()
             if thumbnail:
-                got_pixbuf = True
                 print "Got thumbnail!!!!", thumbnail.get_width(), thumbnail.get_height()
                 thumbnail = self.scale_pixbuf(thumbnail, GIZMO_SIZES[Preferences.gizmoSize])
-        if not got_pixbuf:
-            # Render page
-            pix_w, pix_h = page.get_size()
-            if self.scale == 0:
-                pix_w, pix_h, pix_scale = PixbufUtils.bbox_upscale((pix_w, pix_h), GIZMO_SIZES[Preferences.gizmoSize])
-            else:
-                pix_scale = self.scale
-                pix_w = int(pix_w * self.scale)
-                pix_h = int(pix_h * self.scale)
+                return self.make_shadow(PixbufUtils.rotate_and_crop(thumbnail, rotation, crop))
 
-            antialiasing = Preferences.useAntialiazing
-
-            if antialiasing:
-                pix_w = pix_w*self.antialiazing_factor
-                pix_h = pix_h*self.antialiazing_factor
-                pix_scale = pix_scale*self.antialiazing_factor
-
-            thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False,
-                                       8, pix_w , pix_h)
-
-#            print "render_to_pixbuf", pix_w, pix_h, pix_scale
-            page.render_to_pixbuf(0,0,pix_w,pix_h, pix_scale, 0, thumbnail)
-
-            if antialiasing:
-                thumbnail = self.scale_pixbuf(thumbnail, GIZMO_SIZES[Preferences.gizmoSize])
-        return thumbnail
+        # Render page
+        pix_w, pix_h = page.get_size()
+        if self.scale == 0:
+            pix_w, pix_h, pix_scale = PixbufUtils.bbox_upscale((pix_w, pix_h), GIZMO_SIZES[Preferences.gizmoSize])
+        else:
+            pix_scale = self.scale
+            pix_w = int(pix_w * self.scale)
+            pix_h = int(pix_h * self.scale)
+
+        rotation = PixbufUtils.clockwise_rotation(rotation)
+        if rotation in (90, 270):
+            pix_w, pix_h = pix_h, pix_w
+        src_x, src_y, width, height = PixbufUtils.crop_rect(pix_w, pix_h, crop)
+        src_x, src_y = PixbufUtils.poppler_origin(pix_w, pix_h, rotation,
+                                                  (src_x, src_y, width, height))
+
+        # Previews are rendered smaller and antialiased thumbnails larger
+        # than the result, then resized. Poppler antialiases on its own,
+        # supersampling only smooths thin lines and small text further.
+        factor = 1
+        if preview:
+            factor = 1. / PREVIEW_FACTOR
+        elif Preferences.useAntialiazing:
+            factor = self.supersampling_factor(width, height)
+
+        canvas, page_area = self.new_canvas(width, height)
+        if factor == 1:
+            page.render_to_pixbuf(src_x, src_y, width, height,
+                                  pix_scale, rotation, page_area)
+        else:
+            thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8,
+                                       max(1, int(width * factor)),
+                                       max(1, int(height * factor)))
+            page.render_to_pixbuf(int(src_x * factor), int(src_y * factor),
+                                  thumbnail.get_width(), thumbnail.get_height(),
+                                  pix_scale * factor, rotation, thumbnail)
+            thumbnail.scale(page_area, 0, 0, width, height, 0, 0,
+                            float(width) / thumbnail.get_width(),
+                            float(height) / thumbnail.get_height(),
+                            gtk.gdk.INTERP_BILINEAR)
+        return canvas
 
 
     def render_djvu_page(self, page, gizmo_size, prefer_thumbs=True):
-        """Create pixbuf from page"""
-        import numpy
-
+        """
+        Create pixbuf from page. ddjvu scales while rendering, so the page
+        is never rasterised at its native resolution.
+        """
         assert type(page) is djvu.decode.Page
 
-        # Render page
         page_job = page.decode(wait=True)
-        pix_w, pix_h = page_job.size
-#        pix_w, pix_h = page.get_size()
+        pix_w, pix_h, pix_scale = PixbufUtils.bbox_upscale(page_job.size, GIZMO_SIZES[Preferences.gizmoSize])
         rect = (0, 0, pix_w, pix_h)
 
-#        pb = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, has_alpha=1, bits_per_sample=8, width=pix_h, height=pix_w)
-#        try:
-#            pa = pb.get_pixels_array()
-#        except AttributeError, e:
-#            print e
-#            pa = pb.pixel_array
-
-        mode = djvu.decode.RENDER_FOREGROUND
-        djvu_pixel_format = djvu.decode.PixelFormatRgbMask(0xff0000, 0xff00, 0xff, bpp=32)
-
-        try:
-#            bytes_per_line = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, pix_w)
-            bytes_per_line = pix_w * 4
-            color_buffer = numpy.zeros((pix_h, bytes_per_line), dtype=numpy.uint32)
-            print "1", mode, rect, rect, djvu_pixel_format, bytes_per_line, len(color_buffer)
-            color_buffer = page_job.render(mode, rect, rect, djvu_pixel_format, row_alignment=bytes_per_line) # buffer=color_buffer
-            print "2", type(color_buffer), len(color_buffer)
-    #        mask_buffer = numpy.zeros((pix_h, bytes_per_line), dtype=numpy.uint32)
-    #        if mode == djvu.decode.RENDER_FOREGROUND:
-    #            mask_buffer = page_job.render(djvu.decode.RENDER_MASK_ONLY, rect, rect, djvu_pixel_format, row_alignment=bytes_per_line) # , buffer=mask_buffer
-    #            mask_buffer <<= 24
-    #            color_buffer |= mask_buffer
-    #        color_buffer ^= 0xff000000
-    #        surface = cairo.ImageSurface.create_for_data(color_buffer, cairo.FORMAT_ARGB32, pix_w, pix_h)
-            # remove alpha
-#            out = [object for index, object in enumerate(color_buffer) if index % 4 != 3]
-#            print "Size without alpha:", len(out)
-            thumbnail = gtk.gdk.pixbuf_new_from_data(color_buffer, gtk.gdk.COLORSPACE_RGB, False, 8, pix_w, pix_h, bytes_per_line)
-
-            # Resize
-            thumbnail = self.scale_pixbuf(thumbnail, GIZMO_SIZES[Preferences.gizmoSize])
-
-            print "3"
-            return thumbnail
-        except Exception, e:
-            logging.exception(e)
-
-    def load_pdf_thumbnail(self, pdfdoc, page_number, rotation=0, crop=[0.,0.,0.,0.]):
+        # Packed 24 bit RGB rows aligned to 4 bytes, top row first, as
+        # gdk-pixbuf expects; ddjvu starts from the bottom by default
+        pixel_format = djvu.decode.PixelFormatRgb('RGB')
+        pixel_format.rows_top_to_bottom = 1
+        pixel_format.y_top_to_bottom = 1
+        rowstride = (pix_w * 3 + 3) & ~3
+        pixels = page_job.render(djvu.decode.RENDER_COLOR, rect, rect,
+                                 pixel_format, row_alignment=4)
+        return gtk.gdk.pixbuf_new_from_data(pixels, gtk.gdk.COLORSPACE_RGB, False,
+                                            8, pix_w, pix_h, rowstride)
+
+    def load_pdf_thumbnail(self, pdfdoc, page_number, rotation=0, crop=[0.,0.,0.,0.], preview=False):
         """Create pdf pixbuf"""
         page = pdfdoc.document.get_page(page_number)
         try:
-            thumbnail = self.render_pdf_page(page, GIZMO_SIZES[Preferences.gizmoSize], prefer_thumbs=self.prefer_thumbnails)
-
-            rotation = (-rotation) % 360
-            rotation = ((rotation + 45) / 90) * 90
-            thumbnail = thumbnail.rotate_simple(rotation)
-            pix_w = thumbnail.get_width()
-            pix_h = thumbnail.get_height()
-            if crop != [0.,0.,0.,0.]:
-                src_x = int(crop[0] * pix_w)
-                src_y = int(crop[2] * pix_h)
-                width = int((1. - crop[0] - crop[1]) * pix_w)
-                height = int((1. - crop[2] - crop[3]) * pix_h)
-                new_thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False,
-                                               8, width, height)
-                thumbnail.copy_area(src_x, src_y, width, height,
-                                    new_thumbnail, 0, 0)
-                thumbnail = new_thumbnail
-                pix_w = thumbnail.get_width()
-                pix_h = thumbnail.get_height()
+            return self.render_pdf_page(page, GIZMO_SIZES[Preferences.gizmoSize],
+                                        prefer_thumbs=self.prefer_thumbnails,
+                                        preview=preview, rotation=rotation, crop=crop)
         except Exception, e:
             print "Exception detected:", e
             pix_w = GIZMO_SIZES[Preferences.gizmoSize]
@@ -1637,24 +2708,7 @@ class PDF_Renderer(threading.Thread, gobject.GObject):
         page = pdfdoc.document.pages[page_number]
         try:
             thumbnail = self.render_djvu_page(page, GIZMO_SIZES[Preferences.gizmoSize], prefer_thumbs=self.prefer_thumbnails)
-
-            rotation = (-rotation) % 360
-            rotation = ((rotation + 45) / 90) * 90
-            thumbnail = thumbnail.rotate_simple(rotation)
-            pix_w = thumbnail.get_width()
-            pix_h = thumbnail.get_height()
-            if crop != [0.,0.,0.,0.]:
-                src_x = int(crop[0] * pix_w)
-                src_y = int(crop[2] * pix_h)
-                width = int((1. - crop[0] - crop[1]) * pix_w)
-                height = int((1. - crop[2] - crop[3]) * pix_h)
-                new_thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False,
-                                               8, width, height)
-                thumbnail.copy_area(src_x, src_y, width, height,
-                                    new_thumbnail, 0, 0)
-                thumbnail = new_thumbnail
-                pix_w = thumbnail.get_width()
-                pix_h = thumbnail.get_height()
+            thumbnail = PixbufUtils.rotate_and_crop(thumbnail, rotation, crop)
         except Exception, e:
             print "Exception detected:", e
             pix_w = GIZMO_SIZES[Preferences.gizmoSize]
@@ -1667,38 +2721,33 @@ class PDF_Renderer(threading.Thread, gobject.GObject):
 
         return thumbnail
 
+    def new_canvas(self, pix_w, pix_h):
+        """
+        Allocate a thumbnail for a page of pix_w x pix_h with its border
+        and shadow drawn. Returns the canvas and the subpixbuf (sharing
+        the canvas memory) where the page has to be drawn.
+        """
+        canvas = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8,
+                                pix_w + 3, pix_h + 3)
+        # border
+        for x, y, w, h in ((0, 0, pix_w + 2, 1), (0, pix_h + 1, pix_w + 2, 1),
+                           (0, 1, 1, pix_h), (pix_w + 1, 1, 1, pix_h)):
+            canvas.subpixbuf(x, y, w, h).fill(0x404040FF)
+        # shadow
+        canvas.subpixbuf(pix_w + 2, 1, 1, pix_h + 2).fill(0xA0A090FF)
+        canvas.subpixbuf(1, pix_h + 2, pix_w + 1, 1).fill(0xA0A090FF)
+        # corners left uncovered by the shadow
+        canvas.subpixbuf(pix_w + 2, 0, 1, 1).fill(self.background)
+        canvas.subpixbuf(0, pix_h + 2, 1, 1).fill(self.background)
+        return canvas, canvas.subpixbuf(1, 1, pix_w, pix_h)
+
     def make_shadow(self, thumbnail):
         # add border and shadows
-        # canvas
-        thickness = 2
         pix_w = thumbnail.get_width()
         pix_h = thumbnail.get_height()
-        color = 0xFFFFFF00
-        canvas = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
-                                pix_w + thickness + 1,
-                                pix_h + thickness + 1)
-        canvas.fill(color)
-
-        # border
-        color = 0x404040FF
-        canvas_border = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
-                                pix_w + thickness + 1,
-                                pix_h + thickness + 1)
-        canvas_border.fill(color)
-
-        # shadow
-        color = 0xA0A090FF
-        canvas_shadow = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
-                        pix_w + thickness + 1,
-                        pix_h + thickness + 1)
-        canvas_shadow.fill(color)
-
-        canvas_shadow.copy_area(0, 0, pix_w + 2, pix_h + 2, canvas, 1, 1)
-        canvas_border.copy_area(0, 0, pix_w + 2, pix_h + 2, canvas, 0, 0)
-        thumbnail.copy_area(0, 0, pix_w, pix_h, canvas, 1, 1)
-        thumbnail = canvas
-
-        return thumbnail
+        canvas, page_area = self.new_canvas(pix_w, pix_h)
+        thumbnail.copy_area(0, 0, pix_w, pix_h, page_area, 0, 0)
+        return canvas
 
 
 class PreferencesWindow(gtk.Dialog):
@@ -1725,7 +2774,7 @@ class PreferencesWindow(gtk.Dialog):
         vbox = gtk.VBox()
         vbox.set_border_width(12)
 
-        table = gtk.Table(rows=4, columns=2, homogeneous=False)
+        table = gtk.Table(rows=5, columns=2, homogeneous=False)
         table.set_row_spacings(6)
         table.set_col_spacings(6)
 
@@ -1762,6 +2811,15 @@ class PreferencesWindow(gtk.Dialog):
         self.thumbs_antialiazing.set_label("Use antialiazing")
         table.attach(self.thumbs_antialiazing, 0, 2, 3, 4, gtk.EXPAND | gtk.FILL, gtk.FILL)
 
+        align = gtk.Alignment(0.0, 0.5)
+        label = gtk.Label("Rendering processes (after restart):")
+        align.add(label)
+        table.attach(align, 0, 1, 4, 5, gtk.FILL, gtk.FILL)
+
+        self.render_workers = gtk.SpinButton(gtk.Adjustment(Preferences.renderWorkers, 0, cpu_count(), 1, 4, 0))
+        self.render_workers.set_tooltip_text("0 renders thumbnails in the user interface process")
+        table.attach(self.render_workers, 1, 2, 4, 5, gtk.FILL, gtk.FILL)
+
         return vbox
 
     def _create_page_engine(self):
@@ -1785,7 +2843,7 @@ class PreferencesWindow(gtk.Dialog):
         self.use_pypdf.set_label("PyPDF")
         table.attach(self.use_pypdf, 0, 1, 1, 2, gtk.FILL, gtk.FILL)
 
-        if not found_pypdf:
+        if not have_pypdf():
             image = gtk.Image()
             image.set_from_stock(gtk.STOCK_DIALOG_WARNING, gtk.ICON_SIZE_MENU)
             image.set_tooltip_text("pypdf not installed")
@@ -1797,13 +2855,19 @@ class PreferencesWindow(gtk.Dialog):
         self.use_pdftk.set_label("pdftk")
         table.attach(self.use_pdftk, 0, 1, 2, 3, gtk.EXPAND | gtk.FILL, gtk.FILL)
 
-        if not found_pdftk:
+        if not have_pdftk():
             image = gtk.Image()
             image.set_from_stock(gtk.STOCK_DIALOG_WARNING, gtk.ICON_SIZE_MENU)
             image.set_tooltip_text("pypdf not installed")
             table.attach(image, 1, 2, 2, 3, gtk.EXPAND | gtk.FILL, gtk.FILL)
             self.use_pdftk.set_sensitive(False)
 
+        self.incremental_save = gtk.CheckButton()
+        self.incremental_save.set_active(Preferences.incrementalSave)
+        self.incremental_save.set_label("Save by appending the changes to the file")
+        self.incremental_save.set_tooltip_text("Needs pypdf, whatever the engine")
+        table.attach(self.incremental_save, 0, 2, 3, 4, gtk.EXPAND | gtk.FILL, gtk.FILL)
+
         return vbox
 
     def close(self, widget, event=None, data=None):
@@ -1813,6 +2877,8 @@ class PreferencesWindow(gtk.Dialog):
             Preferences.usePdftk = self.use_pdftk.get_active()
             Preferences.preferThumbnails = self.use_thumbs.get_active()
             Preferences.lazyThumbnailsRendering = self.thumbs_lazy_rendering.get_active()
+            Preferences.renderWorkers = self.render_workers.get_value_as_int()
+            Preferences.incrementalSave = self.incremental_save.get_active()
 # TODO            Preferences.gizmoSize = int(self.zoom.get_active_text())
 
 
@@ -1835,6 +2901,146 @@ class PixbufUtils:
             pix_h = gizmo
         return (pix_w, pix_h, pix_scale)
 
+    @staticmethod
+    def clockwise_rotation(angle):
+        """Round an angle to a multiple of 90 degrees in [0, 360)"""
+        return ((angle % 360 + 45) / 90) * 90 % 360
+
+    @staticmethod
+    def crop_rect(pix_w, pix_h, crop):
+        """Area (x, y, width, height) left by the crop fractions"""
+        src_x = int(crop[0] * pix_w)
+        src_y = int(crop[2] * pix_h)
+        width = max(1, int((1. - crop[0] - crop[1]) * pix_w))
+        height = max(1, int((1. - crop[2] - crop[3]) * pix_h))
+        return src_x, src_y, width, height
+
+    @staticmethod
+    def poppler_origin(pix_w, pix_h, rotation, rect):
+        """
+        The src_x, src_y render_to_pixbuf needs to draw the area rect of the
+        page rotated clockwise by rotation, pix_w x pix_h once rotated.
+        poppler moves the rotated page by src_x + src_width, src_y +
+        src_height along the axes the rotation has flipped, so the origin is
+        counted from the opposite side there.
+        """
+        src_x, src_y, width, height = rect
+        if rotation in (90, 180):
+            src_x = pix_w - src_x - width
+        if rotation in (180, 270):
+            src_y = pix_h - src_y - height
+        return src_x, src_y
+
+    @staticmethod
+    def rotate_and_crop(pixbuf, rotation, crop):
+        """Apply rotation and crop to an already rendered pixbuf"""
+        pixbuf = pixbuf.rotate_simple((360 - PixbufUtils.clockwise_rotation(rotation)) % 360)
+        if crop != [0.,0.,0.,0.]:
+            src_x, src_y, width, height = PixbufUtils.crop_rect(pixbuf.get_width(),
+                                                                pixbuf.get_height(), crop)
+            pixbuf = pixbuf.subpixbuf(src_x, src_y, width, height).copy()
+        return pixbuf
+
+    @staticmethod
+    def color_to_rgba(color):
+        """Convert a gtk.gdk.Color to the 0xRRGGBBAA form of Pixbuf.fill"""
+        return ((color.red >> 8) << 24) | ((color.green >> 8) << 16) | \
+               ((color.blue >> 8) << 8) | 0xFF
+
+    @staticmethod
+    def to_data(pixbuf):
+        """Flatten a pixbuf into a picklable tuple"""
+        return (pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_rowstride(),
+                pixbuf.get_has_alpha(), pixbuf.get_pixels())
+
+    @staticmethod
+    def from_data(data):
+        """Rebuild a pixbuf flattened by to_data"""
+        width, height, rowstride, has_alpha, pixels = data
+        return gtk.gdk.pixbuf_new_from_data(pixels, gtk.gdk.COLORSPACE_RGB,
+                                            has_alpha, 8, width, height, rowstride)
+
+
+
+class WidthHistogram:
+    """
+    Counts the thumbnails of every width, so that the widest one is known
+    without looking at all the rows.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.largest = 0
+
+    def add(self, width):
+        if not width:
+            return
+        self.counts[width] = self.counts.get(width, 0) + 1
+        if width > self.largest:
+            self.largest = width
+
+    def remove(self, width):
+        count = self.counts.get(width)
+        if not count:
+            return
+        if count > 1:
+            self.counts[width] = count - 1
+            return
+        del self.counts[width]
+        if width == self.largest:
+            # Only the distinct widths are looked at
+            self.largest = self.counts and max(self.counts) or 0
+
+    def clear(self):
+        self.counts = {}
+        self.largest = 0
+
+
+class VisibleRangeTracker:
+    """
+    Remembers the range of rows shown by the icon view, so that a repaint
+    only has to deal with the rows that entered or left the viewport.
+    """
+
+    def __init__(self):
+        self.range = None
+        self.shown = None   # The last range, kept when it is invalidated
+        self.backwards = False
+
+    def invalidate(self, *args):
+        """
+        Forget the range, e.g. because rows were added or removed, so that
+        every visible row counts as entered on the next update.
+        """
+        self.range = None
+
+    def update(self, start, end):
+        """
+        Record the new visible range (inclusive). Returns None if it did not
+        change, else the lists of row indices that entered and left it.
+        """
+        old = self.range
+        shown = self.shown
+        self.range = self.shown = (start, end)
+        if old == self.range:
+            return None
+        if shown is None:
+            return range(start, end + 1), []
+        old_start, old_end = shown
+        self.backwards = start < old_start
+        left = [i for i in range(old_start, old_end + 1) if i < start or i > end]
+        if old is None:
+            return range(start, end + 1), left
+        entered = [i for i in range(start, end + 1) if i < old_start or i > old_end]
+        return entered, left
+
+    def ahead(self, n_rows):
+        """Rows to prefetch: as many as are visible, in the scroll direction"""
+        start, end = self.range
+        count = end - start + 1
+        if self.backwards:
+            return range(start - 1, max(-1, start - 1 - count), -1)
+        return range(end + 1, min(n_rows, end + 1 + count))
 
 
 class UndoRedoStack():
@@ -1875,7 +3081,8 @@ class PageDeleteAction(Action):
         return True
 
 
-if __name__ == '__main__':
+def main(render_pool=None, export_pool=None):
+    """Runs the user interface, see the start of this file"""
     gtk.gdk.threads_init()
 
     # Setup logging
@@ -1891,7 +3098,7 @@ if __name__ == '__main__':
     logging.getLogger('').addHandler(consoleHandler)
     logging.info("PdfSnip started...")
 
-    PDFsnip()
+    PDFsnip(render_pool, export_pool)
 #    gtk.gdk.threads_enter()
     gtk.main()
 #    gtk.gdk.threads_leave()
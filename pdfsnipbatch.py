@@ -0,0 +1,676 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+ --------------------------------------------------------------------------
+ PdfSnip batch - the page operations of PdfSnip from the command line.
+
+ Runs without GTK+, poppler or a display, using the document model and the
+ export engine of pdfsnipcore.py.
+ --------------------------------------------------------------------------
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License along
+ with this program; if not, write to the Free Software Foundation, Inc.,
+ 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ --------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import logging
+import multiprocessing
+import multiprocessing.queues
+import optparse
+import threading
+import time
+import errno
+import shlex
+import select
+import struct
+import signal
+import ctypes
+import ctypes.util
+
+from pdfsnipcore import have_pypdf, ListObject, PDF_Doc, DocumentRegistry, \
+                        export_page_list, export_pdf_pages, split_pdf_pages, \
+                        find_blank_pages, split_at_pages, split_every, \
+                        BLANK_PAGE_MAX_BYTES
+
+USAGE = """%prog COMMAND [options] ARGUMENTS
+
+Commands:
+  cat FILE [PAGES...] -o OUT          the PAGES of FILE, in that order
+  merge FILE FILE... -o OUT           all the pages of the FILEs
+  rotate FILE ANGLE [PAGES...] -o OUT rotate PAGES clockwise by ANGLE degrees,
+                                      counterclockwise when negative
+  crop FILE L,R,T,B [PAGES...] -o OUT crop the left, right, top and bottom
+                                      margins of PAGES, given as fractions
+                                      of the page width and height
+  split FILE [PAGES...] -o PATTERN    one file per PAGES argument, per --every
+                                      N pages or per run of pages between
+                                      blank pages with --at-blanks, named
+                                      after PATTERN, e.g. part-%03d.pdf
+  watch DIR JOBFILE -o OUTDIR         apply the steps of JOBFILE to every pdf
+                                      file written to DIR, with --jobs worker
+                                      processes, see load_job()
+
+PAGES are page numbers counted from 1 or ranges like 3-7, 8-end or end-1,
+separated by commas or spaces. All the pages are used when none are given,
+except by split, which takes each PAGES argument as one part."""
+
+COMMANDS = ('cat', 'merge', 'rotate', 'crop', 'split', 'watch')
+
+# The watched directory is also scanned every this many seconds, for the
+# files inotify doesn't report: those already there, or written over NFS/SMB
+WATCH_POLL_INTERVAL = 5
+
+# Times a file is tried when its worker process dies, e.g. killed for
+# running out of memory, before it is moved to the failed directory
+WATCH_JOB_ATTEMPTS = 3
+
+
+class BatchError(Exception):
+    pass
+
+
+def parse_page_ranges(specs, number_of_pages):
+    """Zero based page numbers for page range arguments, see USAGE"""
+    if not specs:
+        return range(number_of_pages)
+
+    def page(text):
+        if text == 'end':
+            return number_of_pages
+        try:
+            number = int(text)
+        except ValueError:
+            raise BatchError(_('Invalid page number: %s') % text)
+        if not 1 <= number <= number_of_pages:
+            raise BatchError(_('No page %d, the document has %d pages') %
+                             (number, number_of_pages))
+        return number
+
+    pages = []
+    for spec in specs:
+        for part in spec.split(','):
+            if not part:
+                continue
+            if '-' in part:
+                first, last = [page(bound) for bound in part.split('-', 1)]
+            else:
+                first = last = page(part)
+            step = first <= last and 1 or -1
+            pages.extend(range(first - 1, last - 1 + step, step))
+    return pages
+
+
+def parse_crop(text):
+    try:
+        crop = [float(side) for side in text.split(',')]
+    except ValueError:
+        crop = []
+    if len(crop) != 4 or min(crop) < 0 or crop[0] + crop[1] >= 1 or \
+       crop[2] + crop[3] >= 1:
+        raise BatchError(_('Invalid crop margins: %s') % text)
+    return crop
+
+
+class PageList:
+    """
+    The documents and the list of pages a command works on, the
+    counterpart of the PdfSnip model.
+    """
+
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.pdfqueue = []
+        self.documents = DocumentRegistry()
+        self.nfile = 0
+        self.objects = []
+
+    def open(self, filename):
+        pdfdoc = self.documents.lookup(filename)
+        if not pdfdoc:
+            if not os.path.isfile(filename):
+                raise BatchError(_('File not found: %s') % filename)
+            pdfdoc = PDF_Doc(filename, self.nfile, self.tmp_dir, render=False)
+            if pdfdoc.nfile == 0:
+                raise BatchError(_('Not a pdf file: %s') % filename)
+            self.nfile = pdfdoc.nfile
+            self.pdfqueue.append(pdfdoc)
+            self.documents.register(pdfdoc)
+        return pdfdoc
+
+    def add_pages(self, filename, specs=None):
+        """Appends the pages of a document and returns them"""
+        pdfdoc = self.open(filename)
+        objects = []
+        for page_number in parse_page_ranges(specs, pdfdoc.number_of_pages):
+            obj = ListObject()
+            obj.text = ''.join([_('page'), ' ', str(page_number + 1)])
+            obj.doc_number = pdfdoc.nfile
+            obj.page_number = page_number
+            obj.doc_filename = pdfdoc.filename
+            obj.rotation_angle = 0
+            objects.append(obj)
+        self.objects.extend(objects)
+        return objects
+
+    def select(self, specs):
+        """The pages of the list chosen by page range arguments"""
+        return [self.objects[index]
+                for index in sorted(set(parse_page_ranges(specs, len(self.objects))))]
+
+    def protect_sources(self, file_out):
+        for pdfdoc in self.pdfqueue:
+            pdfdoc.check_snapshot()
+            # A hard link keeps the original, the output is renamed over it
+            if pdfdoc.snapshot == 'direct' and os.path.exists(file_out) and \
+               os.path.samefile(file_out, pdfdoc.copyname):
+                pdfdoc.make_private_copy()
+
+    def export(self, objects, file_out, workers):
+        self.protect_sources(file_out)
+        export_pdf_pages(export_page_list(objects, self.pdfqueue), file_out,
+                         workers, self.tmp_dir)
+
+    def export_parts(self, parts, pattern, workers):
+        """Writes each list of pages in parts to a file named after pattern"""
+        names = [pattern % (index + 1) for index in range(len(parts))]
+        for file_out in names:
+            self.protect_sources(file_out)
+        split_pdf_pages([(file_out, export_page_list(objects, self.pdfqueue))
+                         for file_out, objects in zip(names, parts)], workers)
+
+
+def parse_step(command, args):
+    """
+    Checks the arguments of a page operation. Returns the step for
+    apply_step(), or for run_steps() when it is a split.
+    """
+    if command == 'cat':
+        return ('cat', args)
+    elif command == 'merge':
+        return ('merge', args)
+    elif command == 'rotate':
+        try:
+            angle = int(args[0])
+        except (IndexError, ValueError):
+            raise BatchError(_('rotate needs an angle'))
+        if angle % 90:
+            raise BatchError(_('The angle must be a multiple of 90'))
+        return ('rotate', angle % 360, args[1:])
+    elif command == 'crop':
+        if not args:
+            raise BatchError(_('crop needs the margins'))
+        return ('crop', parse_crop(args[0]), args[1:])
+    elif command == 'split':
+        # split every N, split at-blanks [SIZE] or split PAGES...
+        try:
+            if args[:1] == ['every'] and len(args) == 2 and int(args[1]) > 0:
+                return ('split', 'every', int(args[1]))
+            if args[:1] == ['at-blanks'] and len(args) <= 2:
+                return ('split', 'blanks', int((args + [BLANK_PAGE_MAX_BYTES])[1]))
+        except ValueError:
+            pass
+        if not args or args[0] in ('every', 'at-blanks'):
+            raise BatchError(_('Invalid split: %s') % ' '.join(args))
+        return ('split', 'ranges', args)
+    raise BatchError(_('Unknown command: %s') % command)
+
+
+def apply_step(pages, step):
+    """Applies a page operation other than split to a PageList"""
+    if step[0] == 'cat':
+        if step[1]:
+            pages.objects = [pages.objects[index]
+                             for index in parse_page_ranges(step[1], len(pages.objects))]
+    elif step[0] == 'merge':
+        for filename in step[1]:
+            pages.add_pages(filename)
+    elif step[0] == 'rotate':
+        for obj in pages.select(step[2]):
+            obj.rotation_angle = (obj.rotation_angle + step[1]) % 360
+    elif step[0] == 'crop':
+        for obj in pages.select(step[2]):
+            obj.crop = list(step[1])
+
+
+def split_parts(pages, mode, value):
+    """The lists of pages a split step writes to separate files"""
+    objects = pages.objects
+    if mode == 'ranges':
+        return [[objects[index] for index in parse_page_ranges([spec], len(objects))]
+                for spec in value]
+    elif mode == 'blanks':
+        blank = find_blank_pages(export_page_list(objects, pages.pdfqueue), value)
+        ranges = split_at_pages(len(objects), blank)
+    else:
+        ranges = split_every(len(objects), value)
+    return [objects[first:last] for first, last in ranges]
+
+
+def run_steps(pages, steps, output, workers):
+    """
+    Applies steps to a PageList and writes the result to output. A split,
+    which can only be the last step, writes a file per part and output is
+    a pattern for their names.
+    """
+    for step in steps:
+        if step[0] != 'split':
+            apply_step(pages, step)
+        elif step is not steps[-1]:
+            raise BatchError(_('split can only be the last step'))
+        elif '%' not in output:
+            raise BatchError(_('The output of split needs a %d in its name'))
+        else:
+            parts = split_parts(pages, step[1], step[2])
+            if not parts:
+                raise BatchError(_('No pages to write'))
+            pages.export_parts(parts, output, workers)
+            return
+    if not pages.objects:
+        raise BatchError(_('No pages to write'))
+    pages.export(pages.objects, output, workers)
+
+
+def run_command(command, args, options, tmp_dir):
+    pages = PageList(tmp_dir)
+    if command == 'merge':
+        step = parse_step(command, args)
+    elif command == 'split':
+        if args[1:] and (options.at_blanks or options.every):
+            raise BatchError(_('Split by PAGES, --every or --at-blanks, not several of them'))
+        if args[1:]:
+            step = ('split', 'ranges', args[1:])
+        elif options.at_blanks:
+            step = ('split', 'blanks', options.blank_size)
+        else:
+            step = ('split', 'every', max(1, options.every or 1))
+        pages.add_pages(args[0])
+    else:
+        step = parse_step(command, args[1:])
+        pages.add_pages(args[0])
+    run_steps(pages, [step], options.output, options.jobs)
+
+
+def load_job(filename):
+    """
+    Reads a job file: one step per line, written like the command line
+    without the input and output files, e.g. "rotate 90 2-end". A split
+    is written "split every N", "split at-blanks [SIZE]" or "split PAGES...".
+    """
+    steps = []
+    for number, line in enumerate(file(filename), 1):
+        words = shlex.split(line, comments=True)
+        if not words:
+            continue
+        try:
+            steps.append(parse_step(words[0], words[1:]))
+        except BatchError, e:
+            raise BatchError('%s:%d: %s' % (filename, number, e))
+    if not steps:
+        raise BatchError(_('%s has no steps') % filename)
+    if 'split' in [step[0] for step in steps[:-1]]:
+        raise BatchError(_('split can only be the last step'))
+    return steps
+
+
+# Worker processes of a hot folder tell it which file they are working on
+_watch_started = None
+
+
+def init_watch_worker(started):
+    global _watch_started
+    _watch_started = started
+
+
+def watch_job(task):
+    """
+    Runs the job for one file of a watched folder, in a worker process.
+    Returns the error message, None on success.
+    """
+    name, attempt, filename, steps, output = task
+    if _watch_started is not None:
+        _watch_started.put((name, attempt, os.getpid()))
+    tmp_dir = tempfile.mkdtemp("pdfsnip")
+    try:
+        try:
+            pages = PageList(tmp_dir)
+            pages.add_pages(filename)
+            # Pool workers can't have processes of their own
+            run_steps(pages, steps, output, 1)
+        except Exception, e:
+            logging.debug("%s failed" % filename, exc_info=True)
+            return str(e) or e.__class__.__name__
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return None
+
+
+def unique_stem(stem, taken):
+    """stem, or the first of stem-2, stem-3... for which taken() is False"""
+    candidate = stem
+    number = 1
+    while taken(candidate):
+        number += 1
+        candidate = '%s-%d' % (stem, number)
+    return candidate
+
+
+class InotifyWatcher:
+    """Tells which files of a directory have been written or moved in (inotify(7))"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        if libc.inotify_add_watch(self.fd, directory,
+                                  self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        """Names of the files written before timeout seconds have passed"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        names = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            names.append(data[offset:offset + length].rstrip('\0'))
+            offset += length
+        return names
+
+
+class PollingWatcher:
+    """Stands in for InotifyWatcher where inotify is not available"""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return []
+
+
+class HotFolder:
+    """
+    Applies a job to every pdf file arriving in in_dir and writes the
+    result to out_dir, from a pool of worker processes. The input files
+    are the queue: they stay in in_dir until processed, then move to its
+    done or failed subdirectory. After a restart, the files still there
+    are processed again, and the outputs are written atomically.
+    """
+
+    def __init__(self, in_dir, out_dir, steps, workers):
+        self.in_dir = in_dir
+        self.out_dir = out_dir
+        self.steps = steps
+        self.workers = max(1, workers)
+        self.done_dir = os.path.join(in_dir, 'done')
+        self.failed_dir = os.path.join(in_dir, 'failed')
+        self.pending = {}       # name -> (attempt, output stem, start time)
+        self.running = {}       # name -> pid of the worker process
+        self.settling = {}
+        self.lock = threading.Lock()
+        self.started = multiprocessing.queues.SimpleQueue()
+
+    def is_input(self, name):
+        return not name.startswith('.') and name.lower().endswith('.pdf') and \
+               os.path.isfile(os.path.join(self.in_dir, name))
+
+    def output_taken(self, stem):
+        """True if the outputs named after stem would overwrite others"""
+        if stem in [output for attempt, output, started in self.pending.values()]:
+            return True
+        return os.path.exists(os.path.join(self.out_dir, stem + '.pdf')) or \
+               os.path.exists(os.path.join(self.out_dir, stem + '-001.pdf'))
+
+    def submit(self, name, attempt=1):
+        self.lock.acquire()
+        try:
+            if attempt == 1:
+                if name in self.pending:
+                    return
+                # Scanners use the same names again and again
+                stem = unique_stem(os.path.splitext(name)[0], self.output_taken)
+            else:
+                stem = self.pending[name][1]
+            started = time.time()
+            self.pending[name] = (attempt, stem, started)
+            self.running.pop(name, None)
+        finally:
+            self.lock.release()
+        self.settling.pop(name, None)
+        logging.info("Queued %s" % name)
+        if self.steps[-1][0] == 'split':
+            output = os.path.join(self.out_dir, stem.replace('%', '%%') + '-%03d.pdf')
+        else:
+            output = os.path.join(self.out_dir, stem + '.pdf')
+        task = (name, attempt, os.path.join(self.in_dir, name), self.steps, output)
+        self.pool.apply_async(watch_job, (task,),
+                              callback=lambda error: self.finished(name, attempt, error))
+
+    def finished(self, name, attempt, error):
+        """Called in the result thread of the pool"""
+        self.lock.acquire()
+        try:
+            if name not in self.pending or self.pending[name][0] != attempt:
+                # Submitted again meanwhile
+                return
+            started = self.pending[name][2]
+        finally:
+            self.lock.release()
+        if error is None:
+            logging.info("Processed %s in %.1f s" % (name, time.time() - started))
+            directory = self.done_dir
+        else:
+            logging.error("Failed to process %s: %s" % (name, error))
+            directory = self.failed_dir
+        stem, ext = os.path.splitext(name)
+        stem = unique_stem(stem, lambda candidate:
+                           os.path.exists(os.path.join(directory, candidate + ext)))
+        try:
+            os.rename(os.path.join(self.in_dir, name), os.path.join(directory, stem + ext))
+        except OSError, e:
+            logging.error("Can't move %s: %s" % (name, e))
+        self.lock.acquire()
+        del self.pending[name]
+        self.running.pop(name, None)
+        self.lock.release()
+
+    def check_workers(self):
+        """
+        Submits again the files whose worker process died, e.g. killed for
+        running out of memory: the pool replaces the worker, but the
+        result of its job never comes.
+        """
+        self.lock.acquire()
+        try:
+            while not self.started.empty():
+                name, attempt, pid = self.started.get()
+                if name in self.pending and self.pending[name][0] == attempt:
+                    self.running[name] = pid
+            running = self.running.items()
+        finally:
+            self.lock.release()
+        for name, pid in running:
+            try:
+                os.kill(pid, 0)
+                continue
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    continue
+            self.lock.acquire()
+            try:
+                if self.running.get(name) != pid:
+                    continue
+                attempt = self.pending[name][0]
+            finally:
+                self.lock.release()
+            if attempt < WATCH_JOB_ATTEMPTS:
+                logging.warning("The worker processing %s died, trying again" % name)
+                self.submit(name, attempt + 1)
+            else:
+                self.finished(name, attempt, _('the worker process died'))
+
+    def poll(self):
+        """
+        Submits the input files that have not changed since the last poll,
+        for the files which were already there or escaped inotify.
+        """
+        self.lock.acquire()
+        pending = set(self.pending)
+        self.lock.release()
+        ready = []
+        for name in os.listdir(self.in_dir):
+            if name in pending or not self.is_input(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.in_dir, name))
+            except OSError:
+                continue
+            stamp = (st.st_size, st.st_mtime)
+            if self.settling.get(name) == stamp:
+                ready.append((st.st_mtime, name))
+            else:
+                self.settling[name] = stamp
+        for mtime, name in sorted(ready):
+            self.submit(name)
+        for name in self.settling.keys():
+            if not os.path.exists(os.path.join(self.in_dir, name)):
+                del self.settling[name]
+
+    def remove_stale_output(self):
+        """Temporary files left behind by outputs cut short by a crash"""
+        for name in os.listdir(self.out_dir):
+            if name.startswith('.') and name.endswith('.pdfsnip-tmp'):
+                os.remove(os.path.join(self.out_dir, name))
+
+    def run(self):
+        for directory in (self.out_dir, self.done_dir, self.failed_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        if os.path.samefile(self.in_dir, self.out_dir):
+            raise BatchError(_('The output directory must not be the watched one'))
+        self.remove_stale_output()
+        try:
+            watcher = InotifyWatcher(self.in_dir)
+        except (OSError, AttributeError, TypeError), e:
+            logging.warning("inotify is not available, polling %s: %s" % (self.in_dir, e))
+            watcher = PollingWatcher()
+
+        self.pool = multiprocessing.Pool(self.workers, init_watch_worker, (self.started,))
+        signal.signal(signal.SIGTERM, stop_watching)
+        logging.info("Watching %s with %d workers" % (self.in_dir, self.workers))
+        try:
+            next_poll = 0
+            while True:
+                now = time.time()
+                if now >= next_poll:
+                    # Also while inotify keeps reporting files
+                    self.poll()
+                    self.check_workers()
+                    next_poll = now + WATCH_POLL_INTERVAL
+                for name in watcher.wait(next_poll - now):
+                    if self.is_input(name):
+                        self.submit(name)
+        finally:
+            # Whatever is left in in_dir is processed after a restart
+            self.pool.terminate()
+
+
+class BatchOptionParser(optparse.OptionParser):
+    """Takes negative numbers, like rotate -90, for arguments"""
+
+    def _process_short_opts(self, rargs, values):
+        if rargs[0][1:].isdigit():
+            self.largs.append(rargs.pop(0))
+        else:
+            optparse.OptionParser._process_short_opts(self, rargs, values)
+
+
+def stop_watching(signum, frame):
+    raise SystemExit(0)
+
+
+def main(argv):
+    parser = BatchOptionParser(usage=USAGE)
+    parser.add_option('-o', '--output', help='the file to write')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(),
+                      help='worker processes [%default]')
+    parser.add_option('-n', '--every', type='int',
+                      help='split: the number of pages of each part')
+    parser.add_option('--at-blanks', action='store_true', default=False,
+                      help='split: at blank pages, which are left out')
+    parser.add_option('--blank-size', type='int', default=BLANK_PAGE_MAX_BYTES,
+                      help='split: the most bytes of content and images a '
+                           'blank page draws [%default]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    (options, args) = parser.parse_args(argv)
+
+    if options.verbose:
+        level = logging.DEBUG
+    elif args[:1] == ['watch']:
+        level = logging.INFO
+    else:
+        level = logging.WARNING
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)-8s %(message)s')
+
+    if not args or args[0] not in COMMANDS:
+        parser.error('a command is needed: ' + ', '.join(COMMANDS))
+    if len(args) < 2:
+        parser.error('no input file')
+    if not options.output:
+        parser.error('no output file, use -o')
+    if not have_pypdf():
+        print >> sys.stderr, _('pyPdf is needed to write pdf files.')
+        return 1
+
+    if args[0] == 'watch':
+        if len(args) != 3:
+            parser.error('watch needs a directory and a job file')
+        try:
+            steps = load_job(args[2])
+            HotFolder(os.path.abspath(args[1]), os.path.abspath(options.output),
+                      steps, options.jobs).run()
+        except (BatchError, IOError, OSError), e:
+            print >> sys.stderr, '%s: %s' % (os.path.basename(sys.argv[0]), e)
+            return 1
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    tmp_dir = tempfile.mkdtemp("pdfsnip")
+    os.chmod(tmp_dir, 0700)
+    try:
+        try:
+            run_command(args[0], args[1:], options, tmp_dir)
+        except Exception, e:
+            logging.debug("%s failed" % args[0], exc_info=True)
+            print >> sys.stderr, '%s: %s' % (os.path.basename(sys.argv[0]), e)
+            return 1
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
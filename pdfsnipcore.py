@@ -0,0 +1,1294 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+ --------------------------------------------------------------------------
+ PdfSnip - document model and export engine.
+
+ Everything here runs without GTK+, poppler or a display: it is shared by
+ the PdfSnip window (pdfsnip.py) and the command line tool (pdfsnipbatch.py).
+ --------------------------------------------------------------------------
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License along
+ with this program; if not, write to the Free Software Foundation, Inc.,
+ 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ --------------------------------------------------------------------------
+"""
+
+import os
+import imp
+import shutil
+import copy
+import multiprocessing
+import tempfile
+import logging
+import itertools
+import errno
+import fcntl
+import StringIO
+import subprocess
+import time
+
+import gettext
+gettext.install('pdfsnip', unicode=1)
+
+# Backends are looked up on first use by have_pypdf() and have_pdftk(), pyPdf
+# is imported by load_pypdf() when a document is first read or written
+found_pypdf = None
+found_pdftk = None
+PdfFileWriter = PdfFileReader = PageObject = None
+NameObject = NumberObject = DictionaryObject = ArrayObject = None
+StreamObject = IndirectObject = None
+
+
+# pyPdf exports are built in chunks of at least EXPORT_CHUNK_MIN_PAGES pages,
+# one process per chunk
+EXPORT_CHUNK_MIN_PAGES = 100
+EXPORT_CHUNKS_PER_WORKER = 4
+
+# Split exports take pages drawing at most this many bytes of content
+# streams and images for blank separator pages: empty pages, and the scans
+# of blank sheets compressed with JBIG2 or CCITT. Noisy scans need more.
+BLANK_PAGE_MAX_BYTES = 256
+
+# ioctl cloning a whole file on copy-on-write filesystems (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def find_program(name):
+    """Full path of an executable in the PATH, or None"""
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def have_pdftk():
+    global found_pdftk
+    if found_pdftk is None:
+        found_pdftk = find_program('pdftk') is not None
+    return found_pdftk
+
+
+def have_pypdf():
+    global found_pypdf
+    if found_pypdf is None:
+        try:
+            imp.find_module('pyPdf')
+            found_pypdf = True
+        except ImportError:
+            found_pypdf = False
+            print("pyPdf wasn't found. Document saving is disabled.")
+    return found_pypdf
+
+
+def load_pypdf():
+    global PdfFileWriter, PdfFileReader, PageObject, NameObject, NumberObject, \
+           DictionaryObject, ArrayObject, StreamObject, IndirectObject
+    if PdfFileWriter is None:
+        from pyPdf import PdfFileWriter, PdfFileReader
+        from pyPdf.pdf import PageObject
+        from pyPdf.generic import NameObject, NumberObject, DictionaryObject, \
+                                 ArrayObject, StreamObject, IndirectObject
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+# The view generation of a render worker process, see RenderPool
+_worker_view_generation = None
+
+
+def render_pool_init(view_generation):
+    global _worker_view_generation
+    _worker_view_generation = view_generation
+
+
+def worker_view_generation():
+    """The view generation shared by the render worker process calling it"""
+    return _worker_view_generation
+
+
+class RenderPool:
+    """
+    The thumbnail render worker processes. They are forked first thing,
+    before the user interface imports GTK+ and sets up gconf and glib, so
+    that they share neither the display connection nor any thread. The
+    workers compare view_generation with that of their jobs to skip the
+    outdated ones.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = cpu_count()
+        self.workers = workers
+        self.view_generation = multiprocessing.Value('i', 0)
+        self.pool = multiprocessing.Pool(workers, render_pool_init,
+                                         (self.view_generation,))
+
+
+# The export generation of an ExportPool worker process, None elsewhere
+_worker_export_generation = None
+
+
+def export_pool_init(generation):
+    global _worker_export_generation
+    _worker_export_generation = generation
+
+
+def check_export_generation(generation):
+    """In an ExportPool worker, raises ExportCancelled once the export is over"""
+    if _worker_export_generation is not None and \
+       _worker_export_generation.value != generation:
+        raise ExportCancelled()
+
+
+class ExportPool:
+    """
+    Worker processes for the pyPdf exports, forked once before the user
+    interface sets up GTK+ and any thread, and used by every export. An
+    export bumps generation when it is over, so that the jobs it leaves
+    running once cancelled stop.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = cpu_count()
+        self.workers = workers
+        self.generation = multiprocessing.Value('i', 0)
+        self.pool = multiprocessing.Pool(workers, export_pool_init, (self.generation,))
+
+
+class ListObject:
+    def __init__(self):
+        self.text = None            # 0.Text descriptor
+        self.doc_number = None      # 2.Document number
+        self.page_number = None     # 3.Page number
+        self.thumbnail_width = None # 4.Thumbnail width
+        self.thumbnail_size = (0, 0)# Thumbnail size
+        self.doc_filename = None    # 5.Document filename
+        self.rendered = False       # 6.Rendered
+        self.rotation_angle = None  # 7.Rotation angle
+        self.crop = [0., 0., 0., 0.]    # 8.Crop left
+        self.need_to_be_rendered = None # 12.Need to be rendered
+        self.generation = 0         # Bumped whenever the thumbnail goes stale
+        self.preview = False        # Showing a low resolution preview
+        self.delivered = None       # Generation of the last full quality thumbnail
+
+
+class ExportError(Exception):
+    pass
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def file_identity(filename):
+    """Identifies the content of a file without reading it"""
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class DocumentRegistry:
+    """
+    Loaded documents indexed by file_identity() of their source, so that
+    finding out whether a file is already open costs a single stat().
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def lookup(self, filename):
+        try:
+            return self.documents.get(file_identity(filename))
+        except OSError:
+            return None
+
+    def register(self, pdfdoc):
+        self.documents[pdfdoc.identity] = pdfdoc
+
+    def unregister(self, pdfdoc):
+        if self.documents.get(pdfdoc.identity) is pdfdoc:
+            del self.documents[pdfdoc.identity]
+
+
+def snapshot_file(filename, copyname):
+    """
+    Make copyname a snapshot of filename without copying the data: try a
+    reflink, then a hard link. Returns the path to read the document from
+    and the method used. With 'direct' the original file itself is read.
+    """
+    try:
+        src = open(filename, 'rb')
+        try:
+            dst = open(copyname, 'wb')
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        return copyname, 'reflink'
+    except (IOError, OSError):
+        if os.path.exists(copyname):
+            os.remove(copyname)
+    try:
+        os.link(filename, copyname)
+        return copyname, 'hardlink'
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    return filename, 'direct'
+
+
+class DocumentSnapshot:
+    """
+    Keeps the pages we show stable while the original file may change.
+    Documents are read through a reflink or a hard link in tmp_dir, or
+    straight from the original file; a real copy is only made when the
+    original is about to be overwritten or has changed under us.
+    """
+
+    def take_snapshot(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.copyname, self.snapshot = snapshot_file(self.filename,
+                                                     self.private_copyname())
+        self.changed = False
+        logging.debug("Opening %s through a %s snapshot" % (self.filename, self.snapshot))
+
+    def private_copyname(self):
+        return os.path.join(self.tmp_dir, '%02d_' % self.nfile +
+                                          self.shortname + '.pdf')
+
+    def snapshot_changed(self):
+        """
+        True if the file we read from no longer has the imported content.
+        Once changed, the pages of the document can't be read any more.
+        """
+        if self.snapshot not in ('hardlink', 'direct'):
+            return False
+        if not self.changed:
+            try:
+                self.changed = file_identity(self.copyname) != self.identity
+            except OSError:
+                self.changed = True
+            if self.changed:
+                logging.warning("%s has changed since it was opened" % self.filename)
+        return self.changed
+
+    def check_snapshot(self):
+        """Raises ExportError if the pages of the document can't be read"""
+        if self.snapshot_changed():
+            raise ExportError(_('File %s has changed since it was opened.') % self.filename)
+
+    def revision(self):
+        """
+        The file identity other processes opening copyname must find, or
+        None for the private copies, which never change.
+        """
+        if self.snapshot not in ('hardlink', 'direct'):
+            return None
+        return self.identity
+
+    def make_private_copy(self, size=None):
+        """
+        Replace a shared snapshot by a real copy, e.g. before a save. With
+        size, only the start of the file is copied: the document as it was
+        before an incremental update was appended to it.
+        """
+        if self.snapshot not in ('hardlink', 'direct'):
+            return
+        if size is None:
+            self.check_snapshot()
+        copyname = self.private_copyname()
+        shutil.copy(self.copyname, copyname + '.tmp')
+        if size is not None:
+            stream = open(copyname + '.tmp', 'r+b')
+            try:
+                stream.truncate(size)
+            finally:
+                stream.close()
+        os.rename(copyname + '.tmp', copyname)
+        self.copyname = copyname
+        self.snapshot = 'copy'
+        self.open_document()
+
+
+class PDF_Doc(DocumentSnapshot):
+    """
+    Class handling pdf documents. Documents opened with render=False are
+    read with pyPdf, so that neither poppler nor GTK+ get loaded.
+    """
+
+    def __init__(self, filename, nfile, tmp_dir, render=True):
+
+        self.render = render
+        self.filename = os.path.abspath(filename)
+        (self.path, self.shortname) = os.path.split(self.filename)
+        (self.shortname, self.ext) = os.path.splitext(self.shortname)
+        if self.ext.lower() == '.pdf':
+            self.nfile = nfile + 1
+            recover_append(self.filename)
+            self.identity = file_identity(self.filename)
+            self.mtime = self.identity[3]
+            self.incremental = None
+            self.take_snapshot(tmp_dir)
+            self.open_document()
+            if self.render:
+                self.number_of_pages = self.document.get_n_pages()
+            else:
+                self.number_of_pages = self.document.getNumPages()
+        else:
+            self.nfile = 0
+
+    def open_document(self):
+        if self.render:
+            import poppler
+            self.document = poppler.document_new_from_file ("file://" + self.copyname, None)
+        else:
+            self.document = open_pdf_reader(self.copyname, self.filename)
+
+    def reopen(self):
+        """
+        Reads the document again from its snapshot, once an incremental
+        update has been appended to the file read.
+        """
+        self.identity = file_identity(self.copyname)
+        self.mtime = self.identity[3]
+        self.changed = False
+        self.open_document()
+        if self.render:
+            self.number_of_pages = self.document.get_n_pages()
+        else:
+            self.number_of_pages = self.document.getNumPages()
+
+
+def temporary_name(filename):
+    """Name a new version of filename is written under before replacing it"""
+    (path, shortname) = os.path.split(filename)
+    return os.path.join(path, '.' + shortname + '.pdfsnip-tmp')
+
+
+def journal_name(filename):
+    """Name of the file recording the size of filename during an append"""
+    (path, shortname) = os.path.split(filename)
+    return os.path.join(path, '.' + shortname + '.pdfsnip-append')
+
+
+def replace_file(file_out, write):
+    """
+    Calls write() with a temporary file name, which then replaces file_out.
+    A failed or cancelled export leaves file_out as it was.
+    """
+    tmpname = temporary_name(file_out)
+    try:
+        write(tmpname)
+        if os.path.exists(file_out):
+            shutil.copymode(file_out, tmpname)
+        os.rename(tmpname, file_out)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def progress_range(progress, start, end):
+    """Maps the progress of a step to the [start, end] part of the whole"""
+    if progress is None:
+        return None
+    return lambda fraction: progress(start + (end - start) * fraction)
+
+
+def open_pdf_reader(copyname, filename=None):
+    """Opens a document for export, refusing the encrypted ones"""
+    load_pypdf()
+    stream = file(copyname, 'rb')
+    # The header may come after up to 1024 bytes of garbage
+    if '%PDF-' not in stream.read(1024):
+        stream.close()
+        raise ExportError(_('File %s is not a pdf file.') % (filename or copyname))
+    stream.seek(0)
+    try:
+        reader = PdfFileReader(stream)
+    except Exception, e:
+        stream.close()
+        raise ExportError(_('File %s can\'t be read: %s') % (filename or copyname,
+                                                             str(e) or e.__class__.__name__))
+    if reader.getIsEncrypted():
+        if reader.decrypt('') != 1: # Workaround for lp:#355479
+            #FIXME
+            #else
+            #   ask for password and decrypt file
+            raise ExportError(_('File %s is encrypted.') % (filename or copyname))
+    return reader
+
+
+def copy_direct_objects(data):
+    """Copy of the direct objects of data, sharing the indirect ones"""
+    if isinstance(data, DictionaryObject):
+        duplicate = copy.copy(data)
+        for key, value in duplicate.items():
+            dict.__setitem__(duplicate, key, copy_direct_objects(value))
+        return duplicate
+    elif isinstance(data, ArrayObject):
+        duplicate = copy.copy(data)
+        for i in range(len(duplicate)):
+            duplicate[i] = copy_direct_objects(duplicate[i])
+        return duplicate
+    return data
+
+
+def get_exported_page(reader, page_number):
+    """
+    Returns a copy of a pyPdf page, so that a page exported twice is not
+    rotated or cropped twice. The copies share no direct object either:
+    PdfFileWriter replaces the references in the objects it writes, and
+    a page exported twice would otherwise have the second copy walk into
+    the pages those references lead to, numbering their objects early.
+    """
+    page = reader.getPage(page_number)
+    exported = PageObject(page.pdf, page.indirectRef)
+    for key, value in page.items():
+        dict.__setitem__(exported, key, copy_direct_objects(value))
+    return exported
+
+
+def edit_exported_page(page, angle, crop):
+    """Applies the rotation and the crop of a row to a pyPdf page"""
+    angle0 = page.get("/Rotate", 0)
+    if angle != 0:
+        page.rotateClockwise(angle)
+    if crop != [0.,0.,0.,0.]:
+        rotate_times = (((angle + angle0) % 360 + 45) / 90) % 4
+        if rotate_times != 0:
+            perm = [0,2,1,3]
+            for it in range(rotate_times):
+                perm.append(perm.pop(0))
+            perm.insert(1,perm.pop(2))
+            crop = [crop[perm[side]] for side in range(4)]
+        (x1, y1) = [float(xy) for xy in page.mediaBox.lowerLeft]
+        (x2, y2) = [float(xy) for xy in page.mediaBox.upperRight]
+        x1_new = int(x1 + (x2-x1) * crop[0])
+        x2_new = int(x2 - (x2-x1) * crop[1])
+        y1_new = int(y1 + (y2-y1) * crop[3])
+        y2_new = int(y2 - (y2-y1) * crop[2])
+        page.mediaBox.lowerLeft = (x1_new, y1_new)
+        page.mediaBox.upperRight = (x2_new, y2_new)
+
+
+def export_page_list(objects, pdfqueue):
+    """
+    The pages to export for a list of ListObject, as taken by
+    export_pdf_pages(). doc_number indexes pdfqueue from 1.
+    """
+    pages = []
+    for obj in objects:
+        pdfdoc = pdfqueue[obj.doc_number - 1]
+        pages.append((pdfdoc.filename, pdfdoc.copyname, obj.page_number,
+                      obj.rotation_angle, list(obj.crop)))
+    return pages
+
+
+def export_pdf_pages(pages, file_out, workers=1, directory=None, progress=None,
+                     export_pool=None):
+    """
+    Writes pages, a list of (filename, copyname, page_number, angle, crop)
+    tuples, to file_out. Long documents are built in chunks by several
+    processes, those of export_pool if given; the result is the same as
+    from the serial writer. progress, if given, is called with the
+    fraction done and may raise ExportCancelled.
+    """
+    load_pypdf()
+    if export_pool is not None:
+        workers = export_pool.workers
+    n_chunks = min(workers * EXPORT_CHUNKS_PER_WORKER,
+                   len(pages) / EXPORT_CHUNK_MIN_PAGES)
+    if workers < 2 or n_chunks < 2:
+        replace_file(file_out, lambda tmpname: write_pdf_pages(pages, tmpname, progress))
+        return
+    bounds = [len(pages) * i / n_chunks for i in range(n_chunks + 1)]
+    # Chunks still being written after a cancel go away with the directory
+    chunk_dir = tempfile.mkdtemp('.chunks', dir=directory)
+    if export_pool is not None:
+        pool = export_pool.pool
+        generation = export_pool.generation.value
+    else:
+        pool = multiprocessing.Pool(min(workers, n_chunks))
+        generation = 0
+    tasks = [(pages, bounds[i], bounds[i + 1], chunk_dir, generation)
+             for i in range(n_chunks)]
+    chunks = []
+    try:
+        for chunk in pool.imap(export_chunk_job, tasks):
+            chunks.append(chunk)
+            if progress:
+                progress(0.5 * len(chunks) / n_chunks)
+        replace_file(file_out, lambda tmpname: join_pdf_chunks(len(pages), chunks, tmpname,
+                                                               progress_range(progress, 0.5, 1.)))
+    finally:
+        if export_pool is not None:
+            export_pool.generation.value += 1
+        else:
+            pool.terminate()
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+
+def write_pdf_pages(pages, file_out, progress=None):
+    """The serial writer, see export_pdf_pages()"""
+    pdf_output = PdfFileWriter()
+    pdf_input = {}
+    for index, (filename, copyname, page_number, angle, crop) in enumerate(pages):
+        if copyname not in pdf_input:
+            pdf_input[copyname] = open_pdf_reader(copyname, filename)
+        current_page = get_exported_page(pdf_input[copyname], page_number)
+        edit_exported_page(current_page, angle, crop)
+        pdf_output.addPage(current_page)
+        if progress:
+            progress(0.5 * (index + 1) / len(pages))
+    write_pdf_output(pdf_output, file_out, progress_range(progress, 0.5, 1.))
+
+
+class ProgressObject:
+    """Object of a PdfFileWriter reporting the progress once written"""
+
+    def __init__(self, obj, progress, fraction):
+        self.obj = obj
+        self.progress = progress
+        self.fraction = fraction
+
+    def writeToStream(self, stream, encryption_key):
+        self.obj.writeToStream(stream, encryption_key)
+        self.progress(self.fraction)
+
+
+def write_pdf_output(pdf_output, file_out, progress=None):
+    """
+    PdfFileWriter.write() to file_out. To report the progress, the objects
+    to write are looked up beforehand, the way write() itself does it.
+    """
+    if progress:
+        extern = {}
+        for index, obj in enumerate(pdf_output._objects):
+            if isinstance(obj, PageObject) and obj.indirectRef is not None:
+                ref = obj.indirectRef
+                extern.setdefault(ref.pdf, {}).setdefault(ref.generation, {})[ref.idnum] = \
+                    IndirectObject(index + 1, 0, pdf_output)
+        pdf_output.stack = []
+        pdf_output._sweepIndirectReferences(extern, pdf_output._root)
+        del pdf_output.stack
+        total = len(pdf_output._objects)
+        pdf_output._objects = [ProgressObject(obj, progress, float(index + 1) / total)
+                               for index, obj in enumerate(pdf_output._objects)]
+    stream = file(file_out, 'wb')
+    try:
+        pdf_output.write(stream)
+    finally:
+        stream.close()
+
+
+def run_pdftk(args, file_out, expected_size=0, progress=None):
+    """
+    Runs pdftk with args and 'output file_out'. pdftk does not tell how far
+    it is, so the progress is guessed from the size of the output so far.
+    """
+    def write(tmpname):
+        process = subprocess.Popen(args + ['output', tmpname])
+        try:
+            while process.poll() is None:
+                time.sleep(0.2)
+                if progress and expected_size:
+                    try:
+                        size = os.path.getsize(tmpname)
+                    except OSError:
+                        size = 0
+                    progress(min(0.99, float(size) / expected_size))
+        except:
+            process.kill()
+            process.wait()
+            raise
+        if process.returncode != 0:
+            raise ExportError(_('pdftk failed with exit status %d') % process.returncode)
+    replace_file(file_out, write)
+
+
+class ChunkReference:
+    """
+    Reference written by a chunk of an export: to a local object ('obj'),
+    to an exported page ('page') or to the page tree ('pages').
+    """
+
+    def __init__(self, kind, number=0):
+        self.kind = kind
+        self.number = number
+
+
+class ChunkStream:
+    """
+    File-like object recording the chunk file as a list of pieces, the
+    byte ranges ('data', start, end) and the references (kind, number)
+    in between them.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pieces = []
+        self.start = stream.tell()
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def reference(self, ref):
+        self.take_data()
+        self.pieces.append((ref.kind, ref.number))
+
+    def take_data(self):
+        end = self.stream.tell()
+        if end > self.start:
+            self.pieces.append(('data', self.start, end))
+        self.start = end
+
+    def take(self):
+        self.take_data()
+        pieces = self.pieces
+        self.pieces = []
+        return pieces
+
+
+class ChunkWriter:
+    """
+    Collects the objects used by a chunk of exported pages. The objects are
+    found and numbered exactly like PdfFileWriter does, with the references
+    left symbolic, so that join_pdf_chunks() can renumber them.
+    """
+
+    def __init__(self):
+        self.objects = []
+        self.keys = []
+        self.extern = {}
+        self.names = {}
+
+    def add(self, obj, key=None):
+        self.objects.append(obj)
+        self.keys.append(key)
+        return ChunkReference('obj', len(self.objects))
+
+    def sweep(self, data):
+        if isinstance(data, DictionaryObject):
+            for key, value in data.items():
+                value = self.sweep(value)
+                if isinstance(value, StreamObject):
+                    value = self.add(value)
+                # DictionaryObject only takes PdfObject values
+                dict.__setitem__(data, key, value)
+            return data
+        elif isinstance(data, ArrayObject):
+            for i in range(len(data)):
+                value = self.sweep(data[i])
+                if isinstance(value, StreamObject):
+                    value = self.add(value)
+                data[i] = value
+            return data
+        elif isinstance(data, IndirectObject):
+            key = (self.names[id(data.pdf)], data.generation, data.idnum)
+            ref = self.extern.get(key)
+            if ref is None:
+                obj = data.pdf.getObject(data)
+                ref = self.add(None, key)
+                self.extern[key] = ref
+                self.objects[ref.number - 1] = self.sweep(obj)
+            return ref
+        return data
+
+    def serialize(self, out, data):
+        if isinstance(data, ChunkReference):
+            out.reference(data)
+        elif isinstance(data, StreamObject):
+            data[NameObject("/Length")] = NumberObject(len(data._data))
+            self.serialize_dictionary(out, data)
+            del data["/Length"]
+            out.write("\nstream\n")
+            out.write(data._data)
+            out.write("\nendstream")
+        elif isinstance(data, DictionaryObject):
+            self.serialize_dictionary(out, data)
+        elif isinstance(data, ArrayObject):
+            out.write("[")
+            for value in data:
+                out.write(" ")
+                self.serialize(out, value)
+            out.write(" ]")
+        else:
+            data.writeToStream(out, None)
+
+    def serialize_dictionary(self, out, data):
+        out.write("<<\n")
+        for key, value in data.items():
+            key.writeToStream(out, None)
+            out.write(" ")
+            self.serialize(out, value)
+            out.write("\n")
+        out.write(">>")
+
+
+def export_chunk_job(task):
+    """
+    Builds the pages[first:last] of an export in a worker process. Returns
+    the chunk file with the pieces of its pages and of the (key, pieces)
+    of its objects.
+    """
+    load_pypdf()
+    pages, first, last, directory, generation = task
+    writer = ChunkWriter()
+    readers = {}
+    for filename, copyname, page_number, angle, crop in pages[first:last]:
+        if copyname not in readers:
+            readers[copyname] = open_pdf_reader(copyname, filename)
+            writer.names[id(readers[copyname])] = copyname
+
+    # References to exported pages point to the exported page, as they do
+    # in PdfFileWriter.write()
+    for index, (filename, copyname, page_number, angle, crop) in enumerate(pages):
+        if copyname in readers:
+            ref = readers[copyname].getPage(page_number).indirectRef
+            writer.extern[(copyname, ref.generation, ref.idnum)] = ChunkReference('page', index)
+
+    chunk_pages = []
+    for filename, copyname, page_number, angle, crop in pages[first:last]:
+        check_export_generation(generation)
+        page = get_exported_page(readers[copyname], page_number)
+        edit_exported_page(page, angle, crop)
+        dict.__setitem__(page, NameObject("/Parent"), ChunkReference('pages'))
+        chunk_pages.append(page)
+    for page in chunk_pages:
+        writer.sweep(page)
+
+    fd, chunk_file = tempfile.mkstemp(suffix='.chunk', dir=directory)
+    stream = os.fdopen(fd, 'wb')
+    try:
+        out = ChunkStream(stream)
+        page_pieces = []
+        for page in chunk_pages:
+            writer.serialize(out, page)
+            page_pieces.append(out.take())
+        objects = []
+        for key, obj in zip(writer.keys, writer.objects):
+            writer.serialize(out, obj)
+            objects.append((key, out.take()))
+    finally:
+        stream.close()
+    return chunk_file, page_pieces, objects
+
+
+class SplicedObject:
+    """Object of a joined export, copied from a chunk file"""
+
+    def __init__(self, chunk, pieces, numbers):
+        self.chunk = chunk
+        self.pieces = pieces
+        self.numbers = numbers
+
+    def writeToStream(self, stream, encryption_key):
+        for piece in self.pieces:
+            if piece[0] == 'data':
+                self.chunk.seek(piece[1])
+                remaining = piece[2] - piece[1]
+                while remaining:
+                    data = self.chunk.read(min(remaining, 1024 * 1024))
+                    stream.write(data)
+                    remaining -= len(data)
+            else:
+                stream.write("%d 0 R" % self.numbers[piece[0]](piece[1]))
+
+
+def join_pdf_chunks(n_pages, chunks, file_out, progress=None):
+    """
+    Writes the chunks built by export_chunk_job() as one document. Objects
+    already written by an earlier chunk are shared, which gives the same
+    numbering as PdfFileWriter.
+    """
+    pdf_output = PdfFileWriter()
+    pages = pdf_output.getObject(pdf_output._pages)
+    first_page = len(pdf_output._objects) + 1
+    for i in range(n_pages):
+        pages["/Kids"].append(pdf_output._addObject(None))
+    pages[NameObject("/Count")] = NumberObject(n_pages)
+
+    files = []
+    try:
+        known = {}
+        page_index = 0
+        for chunk_file, page_pieces, objects in chunks:
+            chunk = file(chunk_file, 'rb')
+            files.append(chunk)
+            local = {}
+            numbers = {'obj': local.__getitem__,
+                       'page': lambda index: first_page + index,
+                       'pages': lambda number: pdf_output._pages.idnum}
+
+            # Only what is reachable without going through an object that
+            # an earlier chunk wrote is new
+            new = set()
+            stack = [piece[1] for pieces in page_pieces for piece in pieces if piece[0] == 'obj']
+            while stack:
+                number = stack.pop()
+                key = objects[number - 1][0]
+                if number in new or key in known:
+                    continue
+                new.add(number)
+                stack.extend(piece[1] for piece in objects[number - 1][1] if piece[0] == 'obj')
+
+            for number, (key, pieces) in enumerate(objects, 1):
+                if number in new:
+                    ref = pdf_output._addObject(SplicedObject(chunk, pieces, numbers))
+                    local[number] = ref.idnum
+                    if key is not None:
+                        known[key] = ref.idnum
+                elif key in known:
+                    local[number] = known[key]
+
+            for pieces in page_pieces:
+                pdf_output._objects[first_page + page_index - 1] = SplicedObject(chunk, pieces, numbers)
+                page_index += 1
+
+        write_pdf_output(pdf_output, file_out, progress)
+    finally:
+        for chunk in files:
+            chunk.close()
+
+
+class CopyingReader:
+    """
+    Hands out copies of the objects of a PdfFileReader. PdfFileWriter
+    rewrites the references of the objects it writes in place, so this is
+    what lets one parsed document serve any number of outputs.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def getObject(self, ref):
+        return self.copy(self.reader.getObject(ref))
+
+    def getPage(self, page_number):
+        return self.copy(self.reader.getPage(page_number))
+
+    def getNumPages(self):
+        return self.reader.getNumPages()
+
+    def copy(self, data):
+        """Copies the direct objects in data, with references to self"""
+        if isinstance(data, IndirectObject):
+            return IndirectObject(data.idnum, data.generation, self)
+        elif isinstance(data, DictionaryObject):
+            copy = data.__class__.__new__(data.__class__)
+            copy.__dict__.update(data.__dict__)
+            if isinstance(data, PageObject):
+                copy.pdf = self
+                if data.indirectRef is not None:
+                    copy.indirectRef = self.copy(data.indirectRef)
+            for key, value in data.items():
+                dict.__setitem__(copy, key, self.copy(value))
+            return copy
+        elif isinstance(data, ArrayObject):
+            copy = data.__class__.__new__(data.__class__)
+            copy.__dict__.update(data.__dict__)
+            list.extend(copy, [self.copy(value) for value in data])
+            return copy
+        return data
+
+
+def page_ink_size(reader, page_number):
+    """
+    Bytes of content streams and images drawn by a page, as stored in the
+    file. Blank pages draw next to nothing.
+    """
+    page = reader.getPage(page_number)
+    streams = []
+    if '/Contents' in page:
+        contents = page['/Contents']
+        if isinstance(contents, ArrayObject):
+            streams.extend([ref.getObject() for ref in contents])
+        else:
+            streams.append(contents)
+    if '/Resources' in page and '/XObject' in page['/Resources']:
+        xobjects = page['/Resources']['/XObject']
+        streams.extend([xobjects[name] for name in xobjects])
+    return sum([len(stream._data) for stream in streams if isinstance(stream, StreamObject)])
+
+
+def find_blank_pages(pages, max_bytes=BLANK_PAGE_MAX_BYTES):
+    """Indexes of the blank pages among pages, as taken by export_pdf_pages()"""
+    load_pypdf()
+    readers = {}
+    blank = set()
+    for index, (filename, copyname, page_number, angle, crop) in enumerate(pages):
+        if copyname not in readers:
+            readers[copyname] = open_pdf_reader(copyname, filename)
+        if page_ink_size(readers[copyname], page_number) <= max_bytes:
+            blank.add(index)
+    return blank
+
+
+def split_at_pages(n_pages, separators):
+    """
+    (first, last) ranges of the pages between the separator pages, which
+    themselves are left out
+    """
+    ranges = []
+    first = 0
+    for index in sorted(separators) + [n_pages]:
+        if index > first:
+            ranges.append((first, index))
+        first = index + 1
+    return ranges
+
+
+def split_every(n_pages, every):
+    """(first, last) ranges of every pages each"""
+    return [(first, min(n_pages, first + every)) for first in range(0, n_pages, every)]
+
+
+def write_split_part(file_out, pages, readers):
+    """
+    Writes one part of a split export. readers caches a CopyingReader per
+    document, so that a document is parsed once for all parts.
+    """
+    pdf_output = PdfFileWriter()
+    for filename, copyname, page_number, angle, crop in pages:
+        if copyname not in readers:
+            readers[copyname] = CopyingReader(open_pdf_reader(copyname, filename))
+        current_page = get_exported_page(readers[copyname], page_number)
+        edit_exported_page(current_page, angle, crop)
+        pdf_output.addPage(current_page)
+    replace_file(file_out, lambda tmpname: write_pdf_output(pdf_output, tmpname))
+
+
+# Readers of a split_part_job() worker process, kept from part to part of
+# the split of _split_generation
+_split_readers = {}
+_split_generation = None
+
+
+def split_part_job(task):
+    global _split_generation
+    load_pypdf()
+    file_out, pages, generation = task
+    check_export_generation(generation)
+    if generation != _split_generation:
+        # The documents may have changed since the previous split
+        _split_readers.clear()
+        _split_generation = generation
+    write_split_part(file_out, pages, _split_readers)
+    return file_out
+
+
+def split_pdf_pages(parts, workers=1, progress=None, export_pool=None):
+    """
+    Writes parts, a list of (file_out, pages) tuples with pages as taken by
+    export_pdf_pages(), each to its own file. The parts are written at the
+    same time by up to workers processes, those of export_pool if given.
+    Each part is written atomically, but a failed or cancelled split leaves
+    the parts written so far.
+    """
+    load_pypdf()
+    if export_pool is not None:
+        workers = export_pool.workers
+    if workers < 2 or len(parts) < 2:
+        readers = {}
+        for index, (file_out, pages) in enumerate(parts):
+            write_split_part(file_out, pages, readers)
+            if progress:
+                progress(float(index + 1) / len(parts))
+        return
+    n_workers = min(workers, len(parts))
+    if export_pool is not None:
+        pool = export_pool.pool
+        generation = export_pool.generation.value
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        generation = 0
+    tasks = [(file_out, pages, generation) for file_out, pages in parts]
+    try:
+        # Parts are handed out a few at a time, the readers stay in the workers
+        chunksize = max(1, min(16, len(parts) / (4 * n_workers)))
+        for index, file_out in enumerate(pool.imap_unordered(split_part_job, tasks, chunksize)):
+            if progress:
+                progress(float(index + 1) / len(parts))
+    finally:
+        if export_pool is not None:
+            export_pool.generation.value += 1
+        else:
+            pool.terminate()
+
+
+class IncrementalUpdateError(ExportError):
+    """The changes can't be saved as an incremental update"""
+    pass
+
+
+class IncrementalState:
+    """
+    Where the incremental updates of a document stand: the file identity
+    and last xref offset after the latest save, the first unused object
+    number and the objects the updates have redefined so far.
+    """
+
+    def __init__(self, identity, startxref, first_free=0):
+        self.identity = identity
+        self.startxref = startxref
+        self.first_free = first_free
+        self.rewritten = set()
+
+
+def read_startxref(filename):
+    """Offset of the last cross-reference section of a pdf file"""
+    stream = file(filename, 'rb')
+    try:
+        stream.seek(0, 2)
+        stream.seek(max(0, stream.tell() - 1024))
+        tail = stream.read()
+        position = tail.rfind('startxref')
+        if position == -1:
+            return None
+        try:
+            startxref = int(tail[position + len('startxref'):].split()[0])
+        except (IndexError, ValueError):
+            return None
+        # Only classic xref tables are extended, not xref streams
+        stream.seek(startxref)
+        if stream.read(4) != 'xref':
+            return None
+        return startxref
+    finally:
+        stream.close()
+
+
+def build_incremental_update(copyname, pages, state, offset, progress=None):
+    """
+    Builds an incremental update turning the document read from copyname
+    into the pages, a list of (page_number, angle, crop) tuples. The update
+    is to be appended at offset, after the updates described by state.
+    Returns the bytes to append, the offset of the new xref section, the
+    first unused object number and the redefined objects, or None when the
+    document can't be updated this way. progress is called with the
+    fraction of the pages done.
+    """
+    reader = open_pdf_reader(copyname)
+    if reader.getIsEncrypted():
+        return None
+    catalog = reader.trailer['/Root']
+    pages_ref = catalog.raw_get('/Pages')
+    if not isinstance(pages_ref, IndirectObject):
+        return None
+    original = [reader.getPage(page_number).indirectRef
+                for page_number in range(reader.getNumPages())]
+
+    original_size = reader.trailer['/Size']
+    objects = {}
+    new_numbers = itertools.count(max(state.first_free, original_size))
+    if [page[0] for page in pages] == range(len(original)):
+        # Same pages in the same order: the page tree stays, only the
+        # rotated or cropped pages are redefined
+        for index, (page_number, angle, crop) in enumerate(pages):
+            if progress:
+                progress(float(index) / len(pages))
+            if angle != 0 or crop != [0.,0.,0.,0.]:
+                page = get_exported_page(reader, page_number)
+                edit_exported_page(page, angle, crop)
+                ref = original[page_number]
+                objects[(ref.idnum, ref.generation)] = page
+    else:
+        # The root of the page tree is redefined with all the pages as kids
+        root = DictionaryObject()
+        root.update(reader.getObject(pages_ref))
+        kids = ArrayObject()
+        used = set()
+        for index, (page_number, angle, crop) in enumerate(pages):
+            if progress:
+                progress(float(index) / len(pages))
+            ref = original[page_number]
+            raw_page = reader.getObject(ref)
+            key = (ref.idnum, ref.generation)
+            if key in used:
+                # A page used twice needs a second page object
+                key = (new_numbers.next(), 0)
+            elif angle == 0 and crop == [0.,0.,0.,0.] and \
+                 raw_page.raw_get('/Parent') == pages_ref:
+                used.add(key)
+                kids.append(ref)
+                continue
+            used.add(key)
+            page = get_exported_page(reader, page_number)
+            edit_exported_page(page, angle, crop)
+            page[NameObject('/Parent')] = pages_ref
+            objects[key] = page
+            kids.append(IndirectObject(key[0], key[1], reader))
+        root[NameObject('/Kids')] = kids
+        root[NameObject('/Count')] = NumberObject(len(kids))
+        objects[(pages_ref.idnum, pages_ref.generation)] = root
+
+    # What earlier updates changed and is no longer changed goes back to
+    # the original
+    for idnum, generation in state.rewritten:
+        if (idnum, generation) not in objects and idnum < original_size:
+            objects[(idnum, generation)] = reader.getObject(IndirectObject(idnum, generation, reader))
+
+    for obj in objects.values():
+        for value in obj.values():
+            if isinstance(value, StreamObject):
+                return None
+
+    stream = StringIO.StringIO()
+    stream.write('\n')
+    positions = {}
+    for key in sorted(objects):
+        positions[key] = offset + stream.tell()
+        stream.write('%d %d obj\n' % key)
+        objects[key].writeToStream(stream, None)
+        stream.write('\nendobj\n')
+
+    xref = offset + stream.tell()
+    stream.write('xref\n0 1\n%010d %05d f \n' % (0, 65535))
+    keys = sorted(positions)
+    while keys:
+        run = 1
+        while run < len(keys) and keys[run][0] == keys[0][0] + run:
+            run += 1
+        stream.write('%d %d\n' % (keys[0][0], run))
+        for key in keys[:run]:
+            stream.write('%010d %05d n \n' % (positions[key], key[1]))
+        keys = keys[run:]
+
+    first_free = max(new_numbers.next(), state.first_free)
+    trailer = DictionaryObject()
+    for name in ('/Root', '/Info', '/ID'):
+        if name in reader.trailer:
+            trailer[NameObject(name)] = reader.trailer.raw_get(name)
+    trailer[NameObject('/Size')] = NumberObject(max(first_free, original_size))
+    trailer[NameObject('/Prev')] = NumberObject(state.startxref)
+    stream.write('trailer\n')
+    trailer.writeToStream(stream, None)
+    stream.write('\nstartxref\n%d\n%%%%EOF\n' % xref)
+    return stream.getvalue(), xref, first_free, set(objects)
+
+
+def append_to_file(filename, data):
+    """
+    Appends data to filename. A reflink of the file gets the data and then
+    replaces the file. Without reflinks the data is appended in place, so
+    the size of the file is recorded first in a journal next to it: an
+    append cut short by a crash is undone by recover_append() the next
+    time the file is opened, and a failed one is cut off right away.
+    """
+    tmpname = temporary_name(filename)
+    dst = open(tmpname, 'wb')
+    try:
+        try:
+            src = open(filename, 'rb')
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            finally:
+                src.close()
+            cloned = True
+        except (IOError, OSError):
+            cloned = False
+        if cloned:
+            dst.seek(0, 2)
+            dst.write(data)
+            dst.flush()
+            os.fsync(dst.fileno())
+    except:
+        dst.close()
+        os.remove(tmpname)
+        raise
+    dst.close()
+    if cloned:
+        shutil.copymode(filename, tmpname)
+        os.rename(tmpname, filename)
+        return
+    os.remove(tmpname)
+
+    st = os.stat(filename)
+    journal = journal_name(filename)
+    stream = open(journal, 'wb')
+    try:
+        stream.write('%d %d\n' % (st.st_ino, st.st_size))
+        stream.flush()
+        os.fsync(stream.fileno())
+    finally:
+        stream.close()
+    sync_directory(journal)
+
+    stream = open(filename, 'r+b')
+    try:
+        stream.seek(0, 2)
+        try:
+            stream.write(data)
+            stream.flush()
+            os.fsync(stream.fileno())
+        except:
+            stream.truncate(st.st_size)
+            raise
+    finally:
+        stream.close()
+    os.remove(journal)
+
+
+def sync_directory(filename):
+    """Makes the entry of filename in its directory durable"""
+    fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def recover_append(filename):
+    """
+    Cuts off what an append_to_file() cut short by a crash left at the end
+    of filename. Returns True if the file had to be repaired.
+    """
+    journal = journal_name(filename)
+    if not os.path.exists(journal):
+        return False
+    repaired = False
+    try:
+        stream = open(journal, 'rb')
+        try:
+            inode, size = [int(field) for field in stream.read().split()]
+        finally:
+            stream.close()
+        st = os.stat(filename)
+        if st.st_ino == inode and st.st_size > size:
+            logging.warning("Removing the unfinished update at the end of %s" % filename)
+            stream = open(filename, 'r+b')
+            try:
+                stream.truncate(size)
+                os.fsync(stream.fileno())
+            finally:
+                stream.close()
+            repaired = True
+    except (IOError, OSError, ValueError), e:
+        # A journal cut short itself was written before the append started
+        logging.warning("Can't recover %s: %s" % (filename, e))
+    try:
+        os.remove(journal)
+    except OSError, e:
+        logging.warning("Can't remove %s: %s" % (journal, e))
+    return repaired
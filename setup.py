@@ -61,7 +61,8 @@ setup(name='pdfsnip',
       description='GTK+ based utility for splitting, rearrangement and modification of PDF documents.',
       url = 'http://code.google.com/p/pdfsnip/',
       license='GNU GPL-2',
-      scripts=['pdfsnip.py'],
+      scripts=['pdfsnip.py', 'pdfsnipbatch.py'],
+      py_modules=['pdfsnipcore'],
       data_files=data_files
      )
 
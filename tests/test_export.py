@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Tests of the pyPdf export engine of pdfsnipcore.py.
+ Run from the top directory with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdfsnipcore
+
+
+def make_pdf(filename, n_pages, tag):
+    """
+    Writes a document whose pages share a font and a form, each page
+    linking to two other pages, as found in books and reports.
+    """
+    objects = []
+    def add(body):
+        objects.append(body)
+        return len(objects)
+    catalog = add(None)
+    pages = add(None)
+    font = add('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    drawing = '0 0 10 10 re f'
+    form = add('<< /Type /XObject /Subtype /Form /BBox [0 0 10 10] /Length %d >>\n'
+               'stream\n%s\nendstream' % (len(drawing), drawing))
+    resources = add('<< /Font << /F1 %d 0 R >> /XObject << /X1 %d 0 R >> >>' % (font, form))
+    page_numbers = [add(None) for i in range(n_pages)]
+    for i, number in enumerate(page_numbers):
+        text = 'BT /F1 24 Tf 72 720 Td (%s page %d) Tj ET /X1 Do' % (tag, i + 1)
+        contents = add('<< /Length %d >>\nstream\n%s\nendstream' % (len(text), text))
+        link = add('<< /Type /Annot /Subtype /Link /Rect [72 700 200 740] '
+                   '/Dest [%d 0 R /Fit] >>' % page_numbers[(i * 7 + 3) % n_pages])
+        back = add('<< /Type /Annot /Subtype /Link /Rect [72 600 200 640] /P %d 0 R '
+                   '/Dest [%d 0 R /XYZ 0 0 0] >>' % (number, page_numbers[(i + 1) % n_pages]))
+        objects[number - 1] = '<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] ' \
+                              '/Resources %d 0 R /Contents %d 0 R /Annots [%d 0 R %d 0 R] >>' % \
+                              (pages, resources, contents, link, back)
+    objects[pages - 1] = '<< /Type /Pages /Kids [%s] /Count %d >>' % \
+                         (' '.join(['%d 0 R' % n for n in page_numbers]), n_pages)
+    objects[catalog - 1] = '<< /Type /Catalog /Pages %d 0 R >>' % pages
+
+    data = '%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += '%d 0 obj\n%s\nendobj\n' % (number, body)
+    startxref = len(data)
+    data += 'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    data += ''.join(['%010d 00000 n \n' % offset for offset in offsets])
+    data += 'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % \
+            (len(objects) + 1, catalog, startxref)
+    stream = open(filename, 'wb')
+    stream.write(data)
+    stream.close()
+
+
+class ChunkedExportTest(unittest.TestCase):
+
+    def setUp(self):
+        if not pdfsnipcore.have_pypdf():
+            self.skipTest('pyPdf is not installed')
+        self.directory = tempfile.mkdtemp('pdfsnip-test')
+        self.chunk_min_pages = pdfsnipcore.EXPORT_CHUNK_MIN_PAGES
+        pdfsnipcore.EXPORT_CHUNK_MIN_PAGES = 5
+        self.documents = []
+        for tag, n_pages in (('A', 12), ('B', 9)):
+            filename = os.path.join(self.directory, tag + '.pdf')
+            make_pdf(filename, n_pages, tag)
+            self.documents.append((filename, n_pages))
+
+    def tearDown(self):
+        pdfsnipcore.EXPORT_CHUNK_MIN_PAGES = self.chunk_min_pages
+        shutil.rmtree(self.directory)
+
+    def export(self, pages, workers):
+        file_out = os.path.join(self.directory, 'out-%d.pdf' % workers)
+        pdfsnipcore.export_pdf_pages(pages, file_out, workers, self.directory)
+        stream = open(file_out, 'rb')
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def test_duplicate_pages(self):
+        """Pages used several times, across chunks, number like the serial writer"""
+        for seed in range(6):
+            generator = random.Random(seed)
+            pages = []
+            for i in range(40):
+                filename, n_pages = generator.choice(self.documents)
+                pages.append((filename, filename, generator.randrange(n_pages),
+                              generator.choice([0, 90, 180]),
+                              generator.choice([[0., 0., 0., 0.], [.1, 0., .2, 0.]])))
+            self.assertEqual(self.export(pages, 1), self.export(pages, 3),
+                             'chunked export differs for seed %d' % seed)
+
+    def test_export_pool(self):
+        """A shared pool writes the same file, also after a cancelled export"""
+        pages = [(filename, filename, page_number, 0, [0., 0., 0., 0.])
+                 for filename, n_pages in self.documents
+                 for page_number in range(n_pages)] * 2
+        expected = self.export(pages, 1)
+        export_pool = pdfsnipcore.ExportPool(3)
+        try:
+            file_out = os.path.join(self.directory, 'out-pool.pdf')
+            def cancel(fraction):
+                if fraction > 0:
+                    raise pdfsnipcore.ExportCancelled()
+            self.assertRaises(pdfsnipcore.ExportCancelled, pdfsnipcore.export_pdf_pages,
+                              pages, file_out, 1, self.directory, cancel, export_pool)
+            self.assertFalse(os.path.exists(file_out))
+            for attempt in range(2):
+                pdfsnipcore.export_pdf_pages(pages, file_out, 1, self.directory,
+                                             None, export_pool)
+                stream = open(file_out, 'rb')
+                try:
+                    self.assertEqual(stream.read(), expected)
+                finally:
+                    stream.close()
+        finally:
+            export_pool.pool.terminate()
+        self.assertEqual([name for name in os.listdir(self.directory)
+                          if 'chunk' in name], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Tests of the incremental saves of pdfsnipcore.py.
+ Run from the top directory with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdfsnipcore
+from test_export import make_pdf
+
+
+class AppendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp('pdfsnip-test')
+        self.filename = os.path.join(self.directory, 'doc.pdf')
+        self.write(self.filename, 'original')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, filename, data, mode='wb'):
+        stream = open(filename, mode)
+        stream.write(data)
+        stream.close()
+
+    def read(self, filename):
+        stream = open(filename, 'rb')
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def test_append(self):
+        pdfsnipcore.append_to_file(self.filename, ' update')
+        self.assertEqual(self.read(self.filename), 'original update')
+        self.assertFalse(os.path.exists(pdfsnipcore.journal_name(self.filename)))
+        self.assertFalse(pdfsnipcore.recover_append(self.filename))
+
+    def test_recover_interrupted_append(self):
+        """What a crash in the middle of an append left is cut off"""
+        st = os.stat(self.filename)
+        self.write(pdfsnipcore.journal_name(self.filename),
+                   '%d %d\n' % (st.st_ino, st.st_size))
+        self.write(self.filename, ' upd', 'ab')
+        self.assertTrue(pdfsnipcore.recover_append(self.filename))
+        self.assertEqual(self.read(self.filename), 'original')
+        self.assertFalse(os.path.exists(pdfsnipcore.journal_name(self.filename)))
+
+    def test_replaced_file_is_kept(self):
+        """A journal left for a file replaced since doesn't truncate the new one"""
+        self.write(pdfsnipcore.journal_name(self.filename), '1 3\n')
+        self.assertFalse(pdfsnipcore.recover_append(self.filename))
+        self.assertEqual(self.read(self.filename), 'original')
+
+    def test_truncated_journal(self):
+        """A journal cut short by a crash was written before the append started"""
+        self.write(pdfsnipcore.journal_name(self.filename), '12')
+        self.assertFalse(pdfsnipcore.recover_append(self.filename))
+        self.assertEqual(self.read(self.filename), 'original')
+        self.assertFalse(os.path.exists(pdfsnipcore.journal_name(self.filename)))
+
+
+class SnapshotUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        if not pdfsnipcore.have_pypdf():
+            self.skipTest('pyPdf is not installed')
+        self.directory = tempfile.mkdtemp('pdfsnip-test')
+        self.tmp_dir = os.path.join(self.directory, 'tmp')
+        os.mkdir(self.tmp_dir)
+        self.filename = os.path.join(self.directory, 'doc.pdf')
+        make_pdf(self.filename, 6, 'A')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def append_update(self, pdfdoc, pages):
+        state = pdfsnipcore.IncrementalState(pdfdoc.identity,
+                                             pdfsnipcore.read_startxref(self.filename))
+        offset = os.path.getsize(self.filename)
+        update = pdfsnipcore.build_incremental_update(pdfdoc.copyname, pages, state, offset)
+        pdfsnipcore.append_to_file(self.filename, update[0])
+        return offset
+
+    def page_texts(self, filename):
+        reader = pdfsnipcore.open_pdf_reader(filename)
+        return [reader.getPage(i).getContents().getData()
+                for i in range(reader.getNumPages())]
+
+    def test_reopen(self):
+        """The pages of a shared snapshot become those of the new revision"""
+        pdfdoc = pdfsnipcore.PDF_Doc(self.filename, 0, self.tmp_dir, render=False)
+        if pdfdoc.revision() is None:
+            self.skipTest('The snapshot is a private copy')
+        expected = self.page_texts(self.filename)[::-1]
+        self.append_update(pdfdoc, [(i, 0, [0.] * 4) for i in range(5, -1, -1)])
+        pdfdoc.reopen()
+        self.assertEqual(pdfdoc.identity, pdfsnipcore.file_identity(pdfdoc.copyname))
+        self.assertEqual(pdfdoc.number_of_pages, 6)
+        self.assertFalse(pdfdoc.snapshot_changed())
+        self.assertEqual(self.page_texts(pdfdoc.copyname), expected)
+
+    def test_private_copy_of_previous_revision(self):
+        """The copy made after an append has the content from before it"""
+        pdfdoc = pdfsnipcore.PDF_Doc(self.filename, 0, self.tmp_dir, render=False)
+        if pdfdoc.revision() is None:
+            self.skipTest('The snapshot is a private copy')
+        expected = self.read(self.filename)
+        offset = self.append_update(pdfdoc, [(1, 0, [0.] * 4), (0, 90, [0.] * 4)])
+        pdfdoc.make_private_copy(offset)
+        self.assertEqual(pdfdoc.snapshot, 'copy')
+        self.assertEqual(self.read(pdfdoc.copyname), expected)
+        self.assertEqual(pdfdoc.document.getNumPages(), 6)
+
+    def read(self, filename):
+        stream = open(filename, 'rb')
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Tests of the thumbnail rendering of pdfsnip.py, which need PyGTK and
+ pypoppler. Run from the top directory with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import gtk
+    import poppler
+    have_gtk = True
+except ImportError:
+    have_gtk = False
+
+
+def make_quadrants_pdf(filename):
+    """A 200 x 300 page with a differently coloured quarter in each corner"""
+    drawing = '1 0 0 rg 0 0 100 150 re f 0 1 0 rg 100 0 100 150 re f ' \
+              '0 0 1 rg 0 150 100 150 re f 1 1 0 rg 100 150 100 150 re f ' \
+              '0 0 0 rg 20 20 30 50 re f'
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+               '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 300] /Contents 4 0 R >>',
+               '<< /Length %d >>\nstream\n%s\nendstream' % (len(drawing), drawing)]
+    data = '%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += '%d 0 obj\n%s\nendobj\n' % (number, body)
+    startxref = len(data)
+    data += 'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    data += ''.join(['%010d 00000 n \n' % offset for offset in offsets])
+    data += 'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % \
+            (len(objects) + 1, startxref)
+    stream = open(filename, 'wb')
+    stream.write(data)
+    stream.close()
+
+
+class RotatedCropTest(unittest.TestCase):
+
+    def setUp(self):
+        if not have_gtk:
+            self.skipTest('PyGTK or pypoppler is not installed')
+        import pdfsnip
+        self.pdfsnip = pdfsnip
+        self.antialiasing = pdfsnip.Preferences.useAntialiazing
+        pdfsnip.Preferences.useAntialiazing = False
+        self.directory = tempfile.mkdtemp('pdfsnip-test')
+        filename = os.path.join(self.directory, 'quadrants.pdf')
+        make_quadrants_pdf(filename)
+        document = poppler.document_new_from_file('file://' + filename, None)
+        self.page = document.get_page(0)
+
+    def tearDown(self):
+        self.pdfsnip.Preferences.useAntialiazing = self.antialiasing
+        shutil.rmtree(self.directory)
+
+    def old_render(self, rotation, crop):
+        """The page rendered upright, then turned with rotate_simple and cut with copy_area"""
+        pix_w, pix_h = [int(size) for size in self.page.get_size()]
+        thumbnail = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, pix_w, pix_h)
+        self.page.render_to_pixbuf(0, 0, pix_w, pix_h, 1., 0, thumbnail)
+        thumbnail = thumbnail.rotate_simple(((-rotation) % 360 + 45) / 90 * 90)
+        pix_w = thumbnail.get_width()
+        pix_h = thumbnail.get_height()
+        src_x = int(crop[0] * pix_w)
+        src_y = int(crop[2] * pix_h)
+        width = int((1. - crop[0] - crop[1]) * pix_w)
+        height = int((1. - crop[2] - crop[3]) * pix_h)
+        cropped = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, width, height)
+        thumbnail.copy_area(src_x, src_y, width, height, cropped, 0, 0)
+        return cropped
+
+    def new_render(self, rotation, crop):
+        renderer = self.pdfsnip.ThumbnailRenderer(1.)
+        canvas = renderer.render_pdf_page(self.page, 0, prefer_thumbs=False,
+                                          rotation=rotation, crop=crop)
+        # Without the border and the shadow
+        return canvas.subpixbuf(1, 1, canvas.get_width() - 3, canvas.get_height() - 3)
+
+    def differing_pixels(self, first, second):
+        width, height = first.get_width(), first.get_height()
+        first_pixels, second_pixels = first.get_pixels(), second.get_pixels()
+        count = 0
+        for y in range(height):
+            first_row = y * first.get_rowstride()
+            second_row = y * second.get_rowstride()
+            for x in range(width):
+                for channel in range(3):
+                    a = ord(first_pixels[first_row + 3 * x + channel])
+                    b = ord(second_pixels[second_row + 3 * x + channel])
+                    if abs(a - b) > 48:
+                        count += 1
+                        break
+        return count
+
+    def test_rotations(self):
+        """Asymmetric crops show the same part of the page at every rotation"""
+        for crop in ([0., 0., 0., 0.], [.1, .25, .05, .3], [.4, 0., 0., .15]):
+            for rotation in (0, 90, 180, 270, -90):
+                old = self.old_render(rotation, crop)
+                new = self.new_render(rotation, crop)
+                self.assertEqual((new.get_width(), new.get_height()),
+                                 (old.get_width(), old.get_height()))
+                self.assertTrue(self.differing_pixels(old, new) <=
+                                old.get_width() * old.get_height() / 100,
+                                'rotation %d, crop %r shows another area' % (rotation, crop))
+
+
+if __name__ == '__main__':
+    unittest.main()